@@ -1,4 +1,4 @@
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, render_template, request, jsonify, Response, stream_with_context
 from selenium import webdriver
 from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.chrome.service import Service
@@ -19,7 +19,19 @@ import subprocess
 import re
 import zipfile
 import webbrowser
-from urllib.parse import quote
+import json
+import queue
+from collections import deque
+import hashlib
+import heapq
+import base64
+import uuid
+import sqlite3
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+from urllib.parse import quote, unquote, urlparse
 from werkzeug.exceptions import HTTPException
 
 warnings.filterwarnings("ignore")
@@ -34,9 +46,6 @@ def handle_exception(e):
 	app.logger.exception("Unhandled exception")
 	return jsonify({'error': str(e)}), 500
 
-driver_lock = threading.Lock()
-driver_instance = None
-
 # Configuración de Selenium
 def get_chrome_info():
 	for binary in ("google-chrome", "chromium", "chromium-browser"):
@@ -51,44 +60,143 @@ def get_chrome_info():
 			return path, None
 	return None, None
 
+BROWSER_CACHE_KEEP = int(os.getenv("DISPATCHER_BROWSER_CACHE_KEEP", "2"))  # versiones que se conservan
+BROWSER_DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+CFT_PLATFORMS = {
+	"nt": "win64",
+	"posix": "linux64"
+}
+
+
+def browser_cache_dir():
+	path = os.path.join(DATA_DIR, "browsers")
+	os.makedirs(os.path.join(path, ".downloads"), exist_ok=True)
+	return path
+
+
+def expected_md5(response):
+	# Google Cloud Storage publica el MD5 en base64 en x-goog-hash
+	for part in (response.headers.get("x-goog-hash") or "").split(","):
+		name, _, value = part.strip().partition("=")
+		if name == "md5" and value:
+			return base64.b64decode(value).hex()
+	return None
+
+
+def stream_download(url, dest, timeout=60):
+	# Descarga por bloques a un .part que se reanuda con Range si quedó a medias
+	part_path = f"{dest}.part"
+	offset = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+	headers = {"Range": f"bytes={offset}-"} if offset else {}
+	md5 = None
+	with requests.get(url, stream=True, timeout=timeout, headers=headers) as response:
+		# 416: el .part ya estaba completo
+		if response.status_code != 416:
+			response.raise_for_status()
+			resumed = response.status_code == 206
+			if not resumed:
+				md5 = expected_md5(response)
+			with open(part_path, "ab" if resumed else "wb") as f:
+				for chunk in response.iter_content(BROWSER_DOWNLOAD_CHUNK_SIZE):
+					if chunk:
+						f.write(chunk)
+	if md5 is None:
+		# En una descarga reanudada el hash de la respuesta no cubre el archivo entero; se pide con HEAD
+		md5 = expected_md5(requests.head(url, timeout=timeout, allow_redirects=True))
+	if md5 and hash_file(part_path, hashlib.md5) != md5:
+		os.unlink(part_path)
+		raise Exception(f"Checksum mismatch for {url}")
+	with zipfile.ZipFile(part_path) as zf:
+		if zf.testzip() is not None:
+			os.unlink(part_path)
+			raise Exception(f"Corrupt archive {url}")
+	os.replace(part_path, dest)
+	return dest
+
+
+def install_archive(url, name):
+	# Extrae en un directorio temporal y lo mueve de una vez: nunca queda una versión a medio instalar
+	cache_dir = browser_cache_dir()
+	final_dir = os.path.join(cache_dir, name)
+	if os.path.isdir(final_dir):
+		return final_dir
+	zip_path = stream_download(url, os.path.join(cache_dir, ".downloads", f"{name}.zip"))
+	staging_dir = tempfile.mkdtemp(prefix=f".staging-{name}-", dir=cache_dir)
+	try:
+		with zipfile.ZipFile(zip_path) as zf:
+			zf.extractall(staging_dir)
+		try:
+			os.replace(staging_dir, final_dir)
+		except OSError:
+			if not os.path.isdir(final_dir):
+				raise
+	finally:
+		shutil.rmtree(staging_dir, ignore_errors=True)
+		try:
+			os.unlink(zip_path)
+		except Exception:
+			pass
+	return final_dir
+
+
+def make_executable(*paths):
+	if os.name == "nt":
+		return
+	for path in paths:
+		if os.path.isfile(path):
+			os.chmod(path, 0o755)
+
+
+def version_key(name):
+	return tuple(int(part) for part in re.findall(r"\d+", name))
+
+
+def prune_browser_cache(keep_names):
+	cache_dir = browser_cache_dir()
+	for prefix in ("chrome-for-testing-", "chromedriver-"):
+		names = sorted(
+			(name for name in os.listdir(cache_dir) if name.startswith(prefix) and name not in keep_names),
+			key=version_key,
+			reverse=True
+		)
+		for name in names[max(0, BROWSER_CACHE_KEEP - 1):]:
+			shutil.rmtree(os.path.join(cache_dir, name), ignore_errors=True)
+	# Restos de versiones anteriores que se descargaban al directorio temporal
+	temp_dir = tempfile.gettempdir()
+	for name in os.listdir(temp_dir):
+		if name.startswith(("chrome-for-testing-", "chromedriver-")) and os.path.isdir(os.path.join(temp_dir, name)):
+			shutil.rmtree(os.path.join(temp_dir, name), ignore_errors=True)
+
+
 def download_chromedriver(chrome_version):
-	if not chrome_version:
+	platform = CFT_PLATFORMS.get(os.name)
+	if not chrome_version or not platform:
 		return None
 
-	dest_dir = os.path.join(tempfile.gettempdir(), f"chromedriver-{chrome_version}")
-	binary_path = os.path.join(dest_dir, "chromedriver-linux64", "chromedriver")
+	name = f"chromedriver-{chrome_version}"
+	binary_path = os.path.join(browser_cache_dir(), name, f"chromedriver-{platform}", "chromedriver.exe" if os.name == "nt" else "chromedriver")
 	if os.path.isfile(binary_path) and os.access(binary_path, os.X_OK):
 		return binary_path
 
 	url = (
 		"https://storage.googleapis.com/chrome-for-testing-public/"
-		f"{chrome_version}/linux64/chromedriver-linux64.zip"
+		f"{chrome_version}/{platform}/chromedriver-{platform}.zip"
 	)
 	try:
-		response = requests.get(url, timeout=30)
-		if response.status_code != 200:
-			return None
-		os.makedirs(dest_dir, exist_ok=True)
-		zip_path = os.path.join(dest_dir, "chromedriver.zip")
-		with open(zip_path, "wb") as f:
-			f.write(response.content)
-		with zipfile.ZipFile(zip_path) as zf:
-			zf.extractall(dest_dir)
+		install_archive(url, name)
+		make_executable(binary_path)
 		if os.path.isfile(binary_path):
-			os.chmod(binary_path, 0o755)
+			prune_browser_cache({name})
 			return binary_path
 	except Exception:
+		app.logger.exception("Could not download chromedriver %s", chrome_version)
 		return None
 
 	return None
 
 
 def download_chrome_for_testing():
-	platform_map = {
-		"nt": "win64",
-		"posix": "linux64"
-	}
-	platform = platform_map.get(os.name)
+	platform = CFT_PLATFORMS.get(os.name)
 	if not platform:
 		return None, None
 
@@ -105,38 +213,28 @@ def download_chrome_for_testing():
 		if not (version and chrome_url and driver_url):
 			return None, None
 
-		dest_dir = os.path.join(tempfile.gettempdir(), f"chrome-for-testing-{version}")
-		chrome_path = os.path.join(dest_dir, f"chrome-{platform}", "chrome.exe" if os.name == "nt" else "chrome")
-		driver_path = os.path.join(dest_dir, f"chromedriver-{platform}", "chromedriver.exe" if os.name == "nt" else "chromedriver")
-
-		if os.path.isfile(chrome_path) and os.path.isfile(driver_path):
-			return chrome_path, driver_path
-
-		os.makedirs(dest_dir, exist_ok=True)
-		chrome_zip = os.path.join(dest_dir, "chrome.zip")
-		driver_zip = os.path.join(dest_dir, "chromedriver.zip")
-
-		chrome_resp = requests.get(chrome_url, timeout=60)
-		chrome_resp.raise_for_status()
-		with open(chrome_zip, "wb") as f:
-			f.write(chrome_resp.content)
-
-		driver_resp = requests.get(driver_url, timeout=60)
-		driver_resp.raise_for_status()
-		with open(driver_zip, "wb") as f:
-			f.write(driver_resp.content)
-
-		with zipfile.ZipFile(chrome_zip) as zf:
-			zf.extractall(dest_dir)
-		with zipfile.ZipFile(driver_zip) as zf:
-			zf.extractall(dest_dir)
+		chrome_name = f"chrome-for-testing-{version}"
+		driver_name = f"chromedriver-{version}"
+		cache_dir = browser_cache_dir()
+		chrome_path = os.path.join(cache_dir, chrome_name, f"chrome-{platform}", "chrome.exe" if os.name == "nt" else "chrome")
+		driver_path = os.path.join(cache_dir, driver_name, f"chromedriver-{platform}", "chromedriver.exe" if os.name == "nt" else "chromedriver")
+
+		if not (os.path.isfile(chrome_path) and os.path.isfile(driver_path)):
+			# Chrome y chromedriver se descargan a la vez
+			with ThreadPoolExecutor(max_workers=2, thread_name_prefix="browser-download") as executor:
+				futures = [
+					executor.submit(install_archive, chrome_url, chrome_name),
+					executor.submit(install_archive, driver_url, driver_name)
+				]
+				for future in futures:
+					future.result()
 
 		if os.path.isfile(chrome_path) and os.path.isfile(driver_path):
-			if os.name != "nt":
-				os.chmod(chrome_path, 0o755)
-				os.chmod(driver_path, 0o755)
+			make_executable(chrome_path, driver_path)
+			prune_browser_cache({chrome_name, driver_name})
 			return chrome_path, driver_path
 	except Exception:
+		app.logger.exception("Could not download Chrome for Testing")
 		return None, None
 
 	return None, None
@@ -150,19 +248,245 @@ def ensure_profile_dir(path):
 	return os.path.isdir(path) and os.access(path, os.W_OK)
 
 
-def get_driver():
-	global driver_instance
-	if driver_instance:
-		try:
-			driver_instance.title  # simple call to verify session
-			return driver_instance
-		except Exception:
+DATA_DIR = os.getenv("DISPATCHER_DATA_DIR", os.path.join(os.path.expanduser("~"), "DispatcherData"))
+
+
+def data_path(name):
+	ensure_profile_dir(DATA_DIR)
+	return os.path.join(DATA_DIR, name)
+
+
+def write_json_atomic(path, payload):
+	tmp_path = f"{path}.tmp"
+	with open(tmp_path, "w", encoding="utf-8") as f:
+		json.dump(payload, f)
+	os.replace(tmp_path, path)
+
+
+# Histogramas por etapa del envío (segundos) y contadores por resultado y código de error
+METRIC_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+metrics_lock = threading.Lock()
+stage_metrics = {}
+message_counts = {}
+error_counts = {}
+stage_context = threading.local()
+
+
+def observe_stage(stage, seconds):
+	with metrics_lock:
+		metric = stage_metrics.setdefault(stage, {'buckets': [0] * len(METRIC_BUCKETS), 'sum': 0.0, 'count': 0})
+		for i, bound in enumerate(METRIC_BUCKETS):
+			if seconds <= bound:
+				metric['buckets'][i] += 1
+		metric['sum'] += seconds
+		metric['count'] += 1
+	# Si el hilo está procesando una fila, la etapa también se anota en sus tiempos
+	timings = getattr(stage_context, 'timings', None)
+	if timings is not None:
+		timings[stage] = round(timings.get(stage, 0.0) + seconds, 3)
+
+
+@contextmanager
+def timed_stage(stage):
+	started = time.monotonic()
+	try:
+		yield
+	finally:
+		observe_stage(stage, time.monotonic() - started)
+
+
+def begin_row_timings():
+	stage_context.timings = {}
+	return stage_context.timings
+
+
+def end_row_timings():
+	timings = getattr(stage_context, 'timings', None) or {}
+	stage_context.timings = None
+	return timings
+
+
+def count_message(status, error_code=None):
+	with metrics_lock:
+		message_counts[status] = message_counts.get(status, 0) + 1
+		if error_code:
+			error_counts[error_code] = error_counts.get(error_code, 0) + 1
+
+
+def render_metrics():
+	lines = [
+		"# HELP dispatcher_stage_seconds Duration of each stage of the send pipeline.",
+		"# TYPE dispatcher_stage_seconds histogram"
+	]
+	with metrics_lock:
+		for stage, metric in sorted(stage_metrics.items()):
+			for bound, count in zip(METRIC_BUCKETS, metric['buckets']):
+				lines.append(f'dispatcher_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {count}')
+			lines.append(f'dispatcher_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {metric["count"]}')
+			lines.append(f'dispatcher_stage_seconds_sum{{stage="{stage}"}} {metric["sum"]:.6f}')
+			lines.append(f'dispatcher_stage_seconds_count{{stage="{stage}"}} {metric["count"]}')
+		lines.append("# HELP dispatcher_messages_total Processed messages by final status.")
+		lines.append("# TYPE dispatcher_messages_total counter")
+		for status, count in sorted(message_counts.items()):
+			lines.append(f'dispatcher_messages_total{{status="{status}"}} {count}')
+		lines.append("# HELP dispatcher_errors_total Failed or skipped messages by error code.")
+		lines.append("# TYPE dispatcher_errors_total counter")
+		for error_code, count in sorted(error_counts.items()):
+			lines.append(f'dispatcher_errors_total{{code="{error_code}"}} {count}')
+	return "\n".join(lines) + "\n"
+
+
+DEFAULT_PROFILE_DIR = os.path.join(os.path.expanduser("~"), "DispatcherWhatsAppProfile")
+# Permite apuntar el navegador a una réplica local (mock_whatsapp.py) para pruebas y benchmarks
+WHATSAPP_WEB_URL = os.getenv("WHATSAPP_WEB_URL", "https://web.whatsapp.com").rstrip("/")
+DEBUG_PORT_BASE = int(os.getenv("WHATSAPP_DEBUG_PORT_BASE", "9222"))
+LIVENESS_INTERVAL = float(os.getenv("WHATSAPP_LIVENESS_INTERVAL", "10"))  # segundos entre comprobaciones reales del navegador
+PREWARM = os.getenv("DISPATCHER_PREWARM", "1") == "1"
+LEAN_MODE = os.getenv("WHATSAPP_LEAN_MODE", "0") == "1"
+# Solo descargas: las subidas de adjuntos van a mmg.whatsapp.net/mms/ y no deben bloquearse
+LEAN_BLOCKED_URLS = [
+	"*://pps.whatsapp.net/*",  # fotos de perfil
+	"*://mmg.whatsapp.net/v/*",  # miniaturas, stickers, audio y video de los chats
+	"*.woff*",
+	"*.ttf*",
+	"*.otf*",
+	"*.mp4*",
+	"*.webm*"
+]
+browser_lock = threading.Lock()  # solo para leer o cambiar browser_manifest
+browser_resolve_lock = threading.Lock()  # una resolución (y descarga de Chrome) a la vez
+browser_manifest = None
+browser_resolving = False
+
+
+def build_sessions():
+	# WHATSAPP_PROFILE_DIRS admite varios perfiles separados por "|" (uno por número vinculado)
+	raw_dirs = os.getenv("WHATSAPP_PROFILE_DIRS") or os.getenv("WHATSAPP_PROFILE_DIR", DEFAULT_PROFILE_DIR)
+	profile_dirs = []
+	for path in raw_dirs.split("|"):
+		path = os.path.abspath(os.path.expanduser(path.strip())) if path.strip() else ""
+		if path and path not in profile_dirs:
+			profile_dirs.append(path)
+	if not profile_dirs:
+		profile_dirs = [DEFAULT_PROFILE_DIR]
+	pool = {}
+	for index, profile_dir in enumerate(profile_dirs):
+		session_id = os.path.basename(profile_dir.rstrip(os.sep)) or f"session-{index}"
+		if session_id in pool:
+			session_id = f"{session_id}-{index}"
+		pool[session_id] = {
+			'id': session_id,
+			'index': index,
+			'profile_dir': profile_dir,
+			'port': DEBUG_PORT_BASE + index,
+			'lock': threading.Lock(),
+			'start_lock': threading.Lock(),
+			'driver': None,
+			'checked_at': 0.0,
+			'memory': None,
+			'health': None,
+			'state': 'cold',
+			'error': None
+		}
+	return pool
+
+
+sessions = build_sessions()
+
+
+def get_session(session_id=None):
+	if session_id:
+		return sessions.get(session_id)
+	return next(iter(sessions.values()))
+
+
+def resolve_profile_dir(session):
+	profile_dir = session['profile_dir']
+	if ensure_profile_dir(profile_dir):
+		return profile_dir
+	fallback = DEFAULT_PROFILE_DIR if session['index'] == 0 else f"{DEFAULT_PROFILE_DIR}-{session['index']}"
+	ensure_profile_dir(fallback)
+	return fallback
+
+
+def close_driver(session):
+	driver = session['driver']
+	session['driver'] = None
+	session['state'] = 'cold'
+	if not driver:
+		return
+	login_state.pop(driver, None)
+	fast_open_failures.pop(driver, None)
+	open_chats.pop(driver, None)
+	try:
+		driver.quit()
+	except Exception:
+		pass
+
+
+def driver_process_alive(driver):
+	process = getattr(getattr(driver, 'service', None), 'process', None)
+	return process is None or process.poll() is None
+
+
+def get_driver(session=None):
+	session = session or get_session()
+	with session['start_lock']:
+		driver = session['driver']
+		if driver:
+			# Dentro del intervalo basta con que chromedriver siga vivo; fuera de él, un viaje real al navegador
+			if time.monotonic() - session['checked_at'] < LIVENESS_INTERVAL and driver_process_alive(driver):
+				return driver
 			try:
-				driver_instance.quit()
+				driver.title
+				session['checked_at'] = time.monotonic()
+				return driver
 			except Exception:
-				pass
-			driver_instance = None
+				close_driver(session)
+		session['state'] = 'starting'
+		try:
+			session['driver'] = launch_driver(session)
+		except Exception as e:
+			session['state'] = 'error'
+			session['error'] = str(e)
+			raise
+		session['checked_at'] = time.monotonic()
+		session['state'] = 'browser_ready'
+		session['error'] = None
+		session['health'] = None
+		return session['driver']
+
 
+def session_state(session):
+	state = session['state']
+	driver = session['driver']
+	if state in ('browser_ready', 'needs_login', 'ready') and driver:
+		return 'ready' if driver in login_state else ('browser_ready' if state == 'ready' else state)
+	return state
+
+
+def prewarm_session(session):
+	try:
+		driver = get_driver(session)
+		with session['lock']:
+			# force=True navega a WhatsApp Web y espera a que cargue
+			session['state'] = 'ready' if ensure_logged_in(driver, force=True) else 'needs_login'
+			sample_session_memory(session)
+	except Exception as e:
+		app.logger.warning("Prewarm of session %s failed: %s", session['id'], e)
+
+
+def prewarm_sessions():
+	# Resuelve Chrome/chromedriver una vez y abre WhatsApp en cada sesión antes del primer envío
+	try:
+		resolve_browser()
+	except Exception:
+		app.logger.exception("Could not resolve Chrome/chromedriver")
+	for session in sessions.values():
+		threading.Thread(target=prewarm_session, args=(session,), name=f"prewarm-{session['id']}", daemon=True).start()
+
+
+def launch_driver(session):
 	options = Options()
 	headless_env = os.getenv("WHATSAPP_HEADLESS", "0") == "1"
 	if os.name == "nt":
@@ -177,7 +501,7 @@ def get_driver():
 	options.add_argument("--disable-extensions")
 	options.add_argument("--disable-software-rasterizer")
 	options.add_argument("--disable-features=VizDisplayCompositor")
-	options.add_argument("--remote-debugging-port=9222")
+	options.add_argument(f"--remote-debugging-port={session['port']}")
 	options.add_argument("--no-first-run")
 	options.add_argument("--no-default-browser-check")
 	options.add_argument("--remote-allow-origins=*")
@@ -188,11 +512,7 @@ def get_driver():
 	user_agent = os.getenv("WHATSAPP_USER_AGENT")
 	if user_agent:
 		options.add_argument(f"--user-agent={user_agent}")
-	default_profile = os.path.join(os.path.expanduser("~"), "DispatcherWhatsAppProfile")
-	profile_dir = os.getenv("WHATSAPP_PROFILE_DIR", default_profile)
-	if not ensure_profile_dir(profile_dir):
-		profile_dir = default_profile
-		ensure_profile_dir(profile_dir)
+	profile_dir = resolve_profile_dir(session)
 	options.add_argument(f"--user-data-dir={profile_dir}")
 	extra_flags = os.getenv("CHROME_FLAGS")
 	if extra_flags:
@@ -200,235 +520,650 @@ def get_driver():
 			flag = flag.strip()
 			if flag:
 				options.add_argument(flag)
-	chrome_path, _chrome_version = get_chrome_info()
+	if LEAN_MODE:
+		# Sin reproducción automática; las descargas pesadas se cortan con LEAN_BLOCKED_URLS (setup_devtools).
+		# No se bloquean todas las imágenes: la vista previa de adjuntos usa miniaturas blob:
+		options.add_argument("--autoplay-policy=user-gesture-required")
+	log_path = os.path.join(tempfile.gettempdir(), f"chromedriver-{session['port']}.log")
+	browser = resolve_browser()
+	try:
+		driver = start_chrome(browser, options, log_path)
+	except Exception:
+		if not browser.get('cached'):
+			raise
+		# El manifiesto pudo quedar obsoleto (Chrome actualizado o desinstalado): se resuelve de nuevo
+		driver = start_chrome(resolve_browser(refresh=True), options, log_path)
+	setup_devtools(driver)
+	return driver
+
+
+def setup_devtools(driver):
+	try:
+		driver.execute_cdp_cmd("Performance.enable", {})
+		if LEAN_MODE:
+			driver.execute_cdp_cmd("Network.enable", {})
+			driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": LEAN_BLOCKED_URLS})
+	except Exception:
+		app.logger.warning("DevTools setup failed; lean mode and memory sampling are unavailable")
+
+
+def sample_browser_memory(driver):
+	try:
+		metrics = driver.execute_cdp_cmd("Performance.getMetrics", {}).get("metrics", [])
+	except Exception:
+		return None
+	values = {metric['name']: metric['value'] for metric in metrics}
+	return {
+		'js_heap_used': int(values.get('JSHeapUsedSize', 0)),
+		'js_heap_total': int(values.get('JSHeapTotalSize', 0)),
+		'nodes': int(values.get('Nodes', 0)),
+		'documents': int(values.get('Documents', 0)),
+		'sampled_at': time.time()
+	}
+
+
+def sample_session_memory(session):
+	driver = session['driver']
+	sample = sample_browser_memory(driver) if driver else None
+	if sample:
+		session['memory'] = sample
+	return sample
+
+
+def start_chrome(browser, options, log_path):
+	if browser['chrome_path']:
+		options.binary_location = browser['chrome_path']
+	if browser['driver_path']:
+		service = Service(browser['driver_path'], log_path=log_path)
+		return webdriver.Chrome(service=service, options=options)
+	# Last resort: Selenium Manager (uses system browser/driver if available)
+	try:
+		return webdriver.Chrome(options=options)
+	except Exception:
+		pass
+	raise RuntimeError(
+		"Chrome/Chromedriver no disponible. Instala Google Chrome/Chromium y chromedriver en el servidor, "
+		"o asegúrate de que el servidor tenga salida a Internet para descargar el driver compatible. "
+		f"Si Chrome se cierra al iniciar, revisa {log_path}."
+	)
+
+
+def find_browser():
+	chrome_path, chrome_version = get_chrome_info()
 	if not chrome_path:
 		chrome_path, downloaded_driver = download_chrome_for_testing()
 		if chrome_path and downloaded_driver:
-			options.binary_location = chrome_path
-			service = Service(downloaded_driver, log_path="/tmp/chromedriver.log")
-			driver_instance = webdriver.Chrome(service=service, options=options)
-			return driver_instance
-	if chrome_path:
-		options.binary_location = chrome_path
+			return {'source': 'chrome-for-testing', 'chrome_path': chrome_path, 'chrome_version': None, 'driver_path': downloaded_driver}
 	# Prefer a downloaded chromedriver compatible with this Chrome
-	downloaded_driver = download_chromedriver(_chrome_version)
+	downloaded_driver = download_chromedriver(chrome_version)
 	if downloaded_driver:
-		service = Service(downloaded_driver, log_path="/tmp/chromedriver.log")
-		driver_instance = webdriver.Chrome(service=service, options=options)
-		return driver_instance
+		return {'source': 'system', 'chrome_path': chrome_path, 'chrome_version': chrome_version, 'driver_path': downloaded_driver}
 
 	# Fallback to system chromedriver/chromium if present
 	chromedriver_path = shutil.which("chromedriver")
 	chromium_path = shutil.which("chromium") or shutil.which("chromium-browser")
 	if chromium_path:
-		options.binary_location = chromium_path
+		chrome_path = chromium_path
 	if chromedriver_path:
-		service = Service(chromedriver_path, log_path="/tmp/chromedriver.log")
-		driver_instance = webdriver.Chrome(service=service, options=options)
-		return driver_instance
+		return {'source': 'system-chromedriver', 'chrome_path': chrome_path, 'chrome_version': chrome_version, 'driver_path': chromedriver_path}
+	return {'source': 'selenium-manager', 'chrome_path': chrome_path, 'chrome_version': chrome_version, 'driver_path': None}
+
+
+def browser_manifest_valid(manifest):
+	for key in ('chrome_path', 'driver_path'):
+		path = manifest.get(key)
+		if path and not os.path.isfile(path):
+			return False
+	# Si Chrome se actualizó, su binario cambia y la versión guardada ya no sirve
+	chrome_path = manifest.get('chrome_path')
+	if chrome_path and os.path.getmtime(chrome_path) != manifest.get('chrome_mtime'):
+		return False
+	return manifest.get('source') != 'selenium-manager'
 
-	# Last resort: Selenium Manager (uses system browser/driver if available)
-	try:
-		driver_instance = webdriver.Chrome(options=options)
-		return driver_instance
-	except Exception:
-		pass
 
-	raise RuntimeError(
-		"Chrome/Chromedriver no disponible. Instala Google Chrome/Chromium y chromedriver en el servidor, "
-		"o asegúrate de que el servidor tenga salida a Internet para descargar el driver compatible. "
-		"Si Chrome se cierra al iniciar, revisa /tmp/chromedriver.log."
-	)
+def resolve_browser(refresh=False):
+	global browser_manifest, browser_resolving
+	# find_browser puede descargar Chrome for Testing: browser_lock no se retiene mientras tanto para no bloquear /ready
+	with browser_resolve_lock:
+		if not refresh:
+			with browser_lock:
+				manifest = browser_manifest
+			if manifest is None:
+				try:
+					with open(data_path("browser.json"), encoding="utf-8") as f:
+						manifest = dict(json.load(f), cached=True)
+				except Exception:
+					manifest = {}
+				with browser_lock:
+					browser_manifest = manifest
+			if manifest and browser_manifest_valid(manifest):
+				return manifest
+		with browser_lock:
+			browser_resolving = True
+		try:
+			started = time.monotonic()
+			manifest = find_browser()
+			manifest['chrome_mtime'] = os.path.getmtime(manifest['chrome_path']) if manifest['chrome_path'] else None
+			manifest['resolved_at'] = time.time()
+			manifest['resolve_seconds'] = round(time.monotonic() - started, 3)
+		finally:
+			with browser_lock:
+				browser_resolving = False
+		try:
+			write_json_atomic(data_path("browser.json"), manifest)
+		except Exception:
+			app.logger.exception("Could not persist browser manifest")
+		manifest = dict(manifest, cached=False)
+		with browser_lock:
+			browser_manifest = manifest
+		return manifest
+
+
+LOGIN_CHECK_TTL = float(os.getenv("WHATSAPP_LOGIN_TTL", "30"))  # segundos
+login_state = {}
+
+
+def mark_logged_in(driver):
+	login_state[driver] = time.monotonic()
+
 
+def invalidate_login_state(driver):
+	login_state.pop(driver, None)
+	open_chats.pop(driver, None)
 
-def ensure_logged_in(driver):
-	driver.get("https://web.whatsapp.com")
-	wait = WebDriverWait(driver, 20)
+
+def is_session_ready(driver):
+	# Comprobación barata sobre la página ya cargada, sin navegar
 	try:
-		# Espera hasta que aparezca el panel/chat list o la caja de búsqueda
-		wait.until(
-			EC.any_of(
-				EC.presence_of_element_located((By.XPATH, "//div[@id='pane-side']")),
-				EC.presence_of_element_located((By.XPATH, "//div[@role='textbox' and @contenteditable='true' and (contains(@aria-label,'Search') or contains(@aria-label,'Buscar'))]"))
-			)
-		)
-		return True
-	except TimeoutException:
+		return bool(driver.execute_script(
+			"return location.host === arguments[0] && !!document.querySelector('#pane-side');",
+			urlparse(WHATSAPP_WEB_URL).netloc
+		))
+	except Exception:
 		return False
 
 
+def ensure_logged_in(driver, force=False):
+	if not force and time.monotonic() - login_state.get(driver, 0.0) < LOGIN_CHECK_TTL:
+		return True
+	with timed_stage('login_check'):
+		if not force and is_session_ready(driver):
+			mark_logged_in(driver)
+			return True
+		invalidate_login_state(driver)
+		load_started = time.monotonic()
+		driver.get(WHATSAPP_WEB_URL)
+		wait = WebDriverWait(driver, 20)
+		try:
+			# Espera hasta que aparezca el panel/chat list o la caja de búsqueda
+			wait.until(
+				EC.any_of(
+					EC.presence_of_element_located((By.XPATH, "//div[@id='pane-side']")),
+					EC.presence_of_element_located((By.XPATH, "//div[@role='textbox' and @contenteditable='true' and (contains(@aria-label,'Search') or contains(@aria-label,'Buscar'))]"))
+				)
+			)
+			observe_stage('page_load', time.monotonic() - load_started)
+			mark_logged_in(driver)
+			return True
+		except TimeoutException:
+			return False
+
+
 
-def wait_for_chat_input(driver, timeout=30):
-	wait = WebDriverWait(driver, timeout)
-	xpaths = [
+# Candidatos por elemento lógico; el resolvedor los consulta todos a la vez y recuerda cuál funcionó
+SELECTORS = {
+	'chat_input': [
 		"//footer//div[@role='textbox' and @contenteditable='true']",
 		"//div[@role='textbox' and @contenteditable='true' and (contains(@aria-label,'message') or contains(@aria-label,'mensaje') or contains(@aria-label,'Message'))]",
 		"//div[@contenteditable='true'][@data-tab='10']"
-	]
-	last_error = None
-	for xpath in xpaths:
-		try:
-			return wait.until(EC.presence_of_element_located((By.XPATH, xpath)))
-		except TimeoutException as exc:
-			last_error = exc
-			continue
-	raise last_error
-
-def wait_for_element(driver, xpaths, timeout=15, clickable=False):
-	wait = WebDriverWait(driver, timeout)
-	for xpath in xpaths:
-		try:
-			if clickable:
-				return wait.until(EC.element_to_be_clickable((By.XPATH, xpath)))
-			return wait.until(EC.presence_of_element_located((By.XPATH, xpath)))
-		except TimeoutException:
-			continue
-	return None
-
-def click_send_button(driver, timeout=15):
-	xpaths = [
+	],
+	'send_button': [
 		"//button[@data-testid='send']",
 		"//button[contains(@data-testid,'send')]",
 		"//span[@data-icon='send']",
 		"//span[@data-testid='send']",
 		"//div[@role='button' and (@aria-label='Send' or @aria-label='Enviar')]",
 		"//button[@aria-label='Send' or @aria-label='Enviar']"
-	]
-	for _ in range(2):
-		button = wait_for_element(driver, xpaths, timeout=timeout, clickable=True)
-		if button:
-			try:
-				button.click()
-				return True
-			except Exception:
-				pass
-		time.sleep(0.5)
-	return False
-
-def attach_files(driver, file_paths):
-	if not file_paths:
-		return False
-	file_paths = [p for p in file_paths if p and os.path.isfile(p)]
-	if not file_paths:
-		return False
-	attach_xpaths = [
+	],
+	'clip': [
 		"//span[@data-icon='clip']",
 		"//span[@data-testid='clip']",
 		"//div[@role='button' and (@aria-label='Attach' or @aria-label='Adjuntar')]",
 		"//button[@title='Attach' or @title='Adjuntar']",
 		"//div[@title='Attach' or @title='Adjuntar']"
-	]
-	document_xpaths = [
+	],
+	'attach_menu': [
+		"//div[@role='dialog']",
+		"//div[@data-testid='attach-menu']",
+		"//div[contains(@class,'attach')]"
+	],
+	'document': [
 		"//span[@data-icon='document']",
 		"//span[@data-testid='attach-document']",
 		"//div[@role='button' and (@aria-label='Document' or @aria-label='Documento')]"
-	]
-	file_input_xpaths = [
+	],
+	'file_input': [
 		"//input[@type='file' and @data-testid='attach-doc']",
 		"//input[@type='file' and @data-testid='attach-document']",
 		"//input[@type='file' and @data-testid='attach-file-input']",
 		"//input[@type='file' and @accept]",
 		"//input[@type='file']"
-	]
-	preview_xpaths = [
+	],
+	'preview': [
 		"//div[@data-testid='media-preview']",
 		"//div[contains(@class,'media-preview')]",
 		"//div[@data-testid='media-preview-section']"
+	],
+	'caption': [
+		"//div[@role='textbox' and @contenteditable='true' and (contains(@aria-label,'caption') or contains(@aria-label,'mensaje') or contains(@aria-label,'message') or contains(@aria-label,'Agregar un mensaje') or contains(@aria-label,'Add a caption'))]",
+		"//div[@contenteditable='true' and @data-testid='media-caption-input-container']"
 	]
-	send_xpaths = [
-		"//button[@data-testid='send']",
-		"//span[@data-icon='send']",
-		"//span[@data-testid='send']"
-	]
-	attach_menu_xpaths = [
-		"//div[@role='dialog']",
-		"//div[@data-testid='attach-menu']",
-		"//div[contains(@class,'attach')]"
-	]
-
-	def _find_file_input():
-		inputs = []
-		try:
-			inputs = driver.find_elements(By.CSS_SELECTOR, "input[type='file']")
-		except Exception:
-			inputs = []
-		if inputs:
-			for element in inputs:
-				try:
-					accept = (element.get_attribute("accept") or "").lower()
-					if not accept or "*" in accept or "application" in accept or "image" in accept:
-						return element
-				except Exception:
-					continue
-			return inputs[-1]
-		return None
-
-	for _ in range(3):
-		attach_button = wait_for_element(driver, attach_xpaths, timeout=12, clickable=True)
-		if not attach_button:
-			time.sleep(1)
-			continue
+}
+# Popup "Phone number shared via url is invalid" / "El número de teléfono compartido a través de la dirección URL no es válido"
+INVALID_NUMBER_XPATH = (
+	"//div[@data-animate-modal-popup='true' or @role='dialog']"
+	"[.//*[contains(text(),'invalid') or contains(text(),'no es válido') or contains(text(),'inválido')"
+	" or contains(text(),'not on WhatsApp') or contains(text(),'no está en WhatsApp')]]"
+)
+# Evalúa todas las XPaths en el navegador en un solo viaje y devuelve la primera coincidencia
+FIND_FIRST_MATCH_SCRIPT = """
+var xpaths = arguments[0], clickable = arguments[1];
+for (var i = 0; i < xpaths.length; i++) {
+	var found = document.evaluate(xpaths[i], document, null, XPathResult.ORDERED_NODE_SNAPSHOT_TYPE, null);
+	for (var j = 0; j < found.snapshotLength; j++) {
+		var el = found.snapshotItem(j);
+		if (!clickable || (el.getClientRects().length > 0 && !el.disabled)) {
+			return [el, i];
+		}
+	}
+}
+return null;
+"""
+selectors_lock = threading.Lock()
+learned_selectors = None
+SELECTOR_PROMOTE_WINS = 3
+SELECTOR_SAVE_DELAY = 5  # segundos
+selector_streaks = {}
+selectors_save_pending = False
+
+
+def load_learned_selectors():
+	global learned_selectors
+	if learned_selectors is None:
 		try:
-			attach_button.click()
+			with open(data_path("selectors.json"), encoding="utf-8") as f:
+				learned_selectors = json.load(f)
 		except Exception:
-			time.sleep(0.5)
-		wait_for_element(driver, attach_menu_xpaths, timeout=4, clickable=False)
-		doc_button = wait_for_element(driver, document_xpaths, timeout=6, clickable=True)
-		if doc_button:
-			try:
-				doc_button.click()
-			except Exception:
-				pass
-		file_input = wait_for_element(driver, file_input_xpaths, timeout=12, clickable=False)
-		if not file_input:
-			file_input = _find_file_input()
-		if not file_input:
-			time.sleep(1)
-			continue
+			learned_selectors = {}
+	return learned_selectors
+
+
+def ordered_selectors(name):
+	candidates = SELECTORS[name]
+	with selectors_lock:
+		learned = load_learned_selectors().get(name)
+	if learned in candidates:
+		return [learned] + [xpath for xpath in candidates if xpath != learned]
+	return list(candidates)
+
+
+def remember_selector(name, xpath):
+	with selectors_lock:
+		learned = load_learned_selectors()
+		if learned.get(name, SELECTORS[name][0]) == xpath:
+			selector_streaks.pop(name, None)
+			return
+		# Un acierto suelto (p. ej. el selector preferido aún no estaba pintado) no cambia el orden
+		previous, wins = selector_streaks.get(name, (None, 0))
+		wins = wins + 1 if previous == xpath else 1
+		if wins < SELECTOR_PROMOTE_WINS:
+			selector_streaks[name] = (xpath, wins)
+			return
+		selector_streaks.pop(name, None)
+		learned[name] = xpath
+		schedule_selectors_save()
+
+
+def schedule_selectors_save():
+	# Se llama con selectors_lock tomado; varias promociones seguidas se guardan en una sola escritura
+	global selectors_save_pending
+	if selectors_save_pending:
+		return
+	selectors_save_pending = True
+	timer = threading.Timer(SELECTOR_SAVE_DELAY, save_learned_selectors)
+	timer.daemon = True
+	timer.start()
+
+
+def save_learned_selectors():
+	global selectors_save_pending
+	with selectors_lock:
+		selectors_save_pending = False
 		try:
-			file_input.send_keys("\n".join(file_paths))
+			write_json_atomic(data_path("selectors.json"), learned_selectors)
 		except Exception:
-			time.sleep(1)
-			continue
-		if wait_for_element(driver, preview_xpaths, timeout=25, clickable=False) or wait_for_element(driver, send_xpaths, timeout=20, clickable=True):
-			return True
-		time.sleep(1)
-	return False
+			app.logger.exception("Could not persist learned selectors")
 
-def set_media_caption(driver, message):
-	if not message:
-		return False
-	caption_xpaths = [
-		"//div[@role='textbox' and @contenteditable='true' and (contains(@aria-label,'caption') or contains(@aria-label,'mensaje') or contains(@aria-label,'message') or contains(@aria-label,'Agregar un mensaje') or contains(@aria-label,'Add a caption'))]",
-		"//div[@contenteditable='true' and @data-testid='media-caption-input-container']"
-	]
-	caption = wait_for_element(driver, caption_xpaths, timeout=6, clickable=True)
-	if not caption:
-		return False
-	try:
-		caption.click()
-		caption.send_keys(message)
-		return True
-	except Exception:
-		return False
 
-def ensure_message_sent(driver, chat_input, message):
-	if not message:
-		return True
+def find_first_match(driver, xpaths, clickable=False):
+	match = driver.execute_script(FIND_FIRST_MATCH_SCRIPT, xpaths, clickable)
+	if not match:
+		return None
+	return match[0], match[1]
+
+
+def wait_for_first_match(driver, xpaths, timeout, clickable=False):
 	try:
-		driver.execute_script("arguments[0].focus();", chat_input)
+		return WebDriverWait(driver, timeout).until(lambda d: find_first_match(d, xpaths, clickable))
+	except TimeoutException:
+		return None
+
+
+def resolve_element(driver, name, timeout=15, clickable=False):
+	candidates = ordered_selectors(name)
+	match = wait_for_first_match(driver, candidates, timeout, clickable)
+	if not match:
+		return None
+	element, index = match
+	remember_selector(name, candidates[index])
+	return element
+
+
+def wait_for_chat_input(driver, timeout=30):
+	with timed_stage('chat_input'):
+		chat_input = resolve_element(driver, 'chat_input', timeout)
+	if not chat_input:
+		raise TimeoutException("chat input not found")
+	return chat_input
+
+
+def dismiss_invalid_number_popup(driver):
+	try:
+		buttons = driver.find_elements(By.XPATH, INVALID_NUMBER_XPATH + "//button")
+		if buttons:
+			buttons[0].click()
 	except Exception:
 		pass
-	existing = ""
+
+
+def raise_if_invalid_number(driver):
+	if driver.find_elements(By.XPATH, INVALID_NUMBER_XPATH):
+		dismiss_invalid_number_popup(driver)
+		raise Exception("error_phone_not_on_whatsapp")
+
+
+def wait_for_chat_or_invalid_number(driver, timeout=20):
+	# Una sola espera: el chat o el aviso de número inválido, lo que aparezca primero
+	candidates = ordered_selectors('chat_input')
+	match = wait_for_first_match(driver, [INVALID_NUMBER_XPATH] + candidates, timeout)
+	if not match:
+		raise TimeoutException("chat input not found")
+	element, index = match
+	if index == 0:
+		dismiss_invalid_number_popup(driver)
+		raise Exception("error_phone_not_on_whatsapp")
+	remember_selector('chat_input', candidates[index - 1])
+	return element
+
+CHAT_OPEN_MODE = os.getenv("WHATSAPP_CHAT_OPEN_MODE", "fast")
+FAST_OPEN_MAX_FAILURES = 3
+fast_open_failures = {}
+open_chats = {}
+
+
+def open_chat_via_url(driver, phone, message, encoded_message=None):
+	if encoded_message is None:
+		encoded_message = quote(message) if message else ""
+	driver.get(f"{WHATSAPP_WEB_URL}/send?phone={phone}&text={encoded_message}&app_absent=0")
+	return wait_for_chat_or_invalid_number(driver, 20)
+
+
+def open_chat_in_app(driver, phone, timeout=8):
+	# Abre el chat dentro de la SPA ya cargada (sin recargar el bundle de WhatsApp Web)
+	if not is_session_ready(driver):
+		return None
+	footer_xpath = "//footer//div[@role='textbox' and @contenteditable='true']"
+	previous = driver.find_elements(By.XPATH, footer_xpath)
+	digits = re.sub(r"\D", "", phone)
+	if previous and current_chat_matches(driver, digits, previous[0]):
+		# El chat del destinatario ya está abierto: el enlace no reemplazaría el pie y solo quedaría esperar
+		chat_input = previous[0]
+	else:
+		chat_input = open_chat_link(driver, digits, previous, footer_xpath, timeout)
+		if not chat_input:
+			return None
+	# El chat puede traer un borrador previo; se limpia para escribir el mensaje actual
+	try:
+		if (chat_input.get_attribute("innerText") or "").strip():
+			chat_input.send_keys(Keys.CONTROL, "a")
+			chat_input.send_keys(Keys.DELETE)
+	except Exception:
+		pass
+	return chat_input
+
+
+def current_chat_matches(driver, digits, chat_input):
+	# Al cambiar de chat el pie se vuelve a crear: el mismo elemento indica que sigue abierto el último chat
+	if open_chats.get(driver) == (digits, chat_input.id):
+		return True
+	# Chats sin contacto guardado muestran el número en la cabecera
 	try:
-		existing = (chat_input.get_attribute("innerText") or "").strip()
+		headers = driver.find_elements(By.XPATH, "//div[@id='main']//header")
+		return bool(headers) and re.sub(r"\D", "", headers[0].get_attribute("innerText") or "") == digits
 	except Exception:
-		existing = ""
-	if not existing:
+		return False
+
+
+def open_chat_link(driver, digits, previous, footer_xpath, timeout):
+	driver.execute_script(
+		"var link = document.createElement('a');"
+		"link.href = 'https://api.whatsapp.com/send?phone=' + arguments[0];"
+		"link.style.display = 'none';"
+		"(document.getElementById('app') || document.body).appendChild(link);"
+		"link.click();"
+		"link.remove();",
+		digits
+	)
+	wait = WebDriverWait(driver, timeout)
+	try:
+		if previous:
+			opened = EC.staleness_of(previous[0])
+		else:
+			opened = EC.presence_of_element_located((By.XPATH, footer_xpath))
+		wait.until(EC.any_of(opened, EC.presence_of_element_located((By.XPATH, INVALID_NUMBER_XPATH))))
+		raise_if_invalid_number(driver)
+		return wait.until(EC.presence_of_element_located((By.XPATH, footer_xpath)))
+	except TimeoutException:
+		return None
+
+
+def open_chat(driver, phone, message, mode=None, encoded_message=None):
+	mode = mode or CHAT_OPEN_MODE
+	if mode == "fast" and fast_open_failures.get(driver, 0) < FAST_OPEN_MAX_FAILURES:
 		try:
-			chat_input.send_keys(message)
+			chat_input = open_chat_in_app(driver, phone)
+		except Exception as e:
+			if str(e) == "error_phone_not_on_whatsapp":
+				raise
+			chat_input = None
+		if chat_input:
+			fast_open_failures[driver] = 0
+			open_chats[driver] = (re.sub(r"\D", "", phone), chat_input.id)
+			return chat_input, "fast"
+		# Tras varios fallos seguidos se desactiva la vía rápida para este navegador
+		fast_open_failures[driver] = fast_open_failures.get(driver, 0) + 1
+	open_chats.pop(driver, None)
+	chat_input = open_chat_via_url(driver, phone, message, encoded_message)
+	open_chats[driver] = (re.sub(r"\D", "", phone), chat_input.id)
+	return chat_input, "url"
+
+
+def click_send_button(driver, timeout=15):
+	for _ in range(2):
+		button = resolve_element(driver, 'send_button', timeout=timeout, clickable=True)
+		if button:
+			try:
+				button.click()
+				return True
+			except Exception:
+				pass
+		time.sleep(0.5)
+	return False
+
+def attach_files(driver, file_paths):
+	if not file_paths:
+		return False
+	file_paths = [p for p in file_paths if p and os.path.isfile(p)]
+	if not file_paths:
+		return False
+	def _find_file_input():
+		inputs = []
+		try:
+			inputs = driver.find_elements(By.CSS_SELECTOR, "input[type='file']")
 		except Exception:
-			pass
+			inputs = []
+		if inputs:
+			for element in inputs:
+				try:
+					accept = (element.get_attribute("accept") or "").lower()
+					if not accept or "*" in accept or "application" in accept or "image" in accept:
+						return element
+				except Exception:
+					continue
+			return inputs[-1]
+		return None
+
+	for _ in range(3):
+		attach_button = resolve_element(driver, 'clip', timeout=12, clickable=True)
+		if not attach_button:
+			time.sleep(1)
+			continue
+		try:
+			attach_button.click()
+		except Exception:
+			time.sleep(0.5)
+		resolve_element(driver, 'attach_menu', timeout=4)
+		doc_button = resolve_element(driver, 'document', timeout=6, clickable=True)
+		if doc_button:
+			try:
+				doc_button.click()
+			except Exception:
+				pass
+		file_input = resolve_element(driver, 'file_input', timeout=12)
+		if not file_input:
+			file_input = _find_file_input()
+		if not file_input:
+			time.sleep(1)
+			continue
+		try:
+			file_input.send_keys("\n".join(file_paths))
+		except Exception:
+			time.sleep(1)
+			continue
+		if resolve_element(driver, 'preview', timeout=25) or resolve_element(driver, 'send_button', timeout=20, clickable=True):
+			return True
+		time.sleep(1)
+	return False
+
+# Inserción en bloque: un evento de pegado (o insertText) en lugar de un send_keys por carácter
+PASTE_TEXT_SCRIPT = """
+var el = arguments[0], text = arguments[1];
+el.focus();
+var data = new DataTransfer();
+data.setData('text/plain', text);
+el.dispatchEvent(new ClipboardEvent('paste', {clipboardData: data, bubbles: true, cancelable: true}));
+"""
+INSERT_TEXT_SCRIPT = """
+var el = arguments[0], text = arguments[1];
+el.focus();
+document.execCommand('insertText', false, text);
+"""
+# innerText omite los emojis (WhatsApp los pinta como <img alt="...">), por eso se recorre el DOM
+COMPOSED_TEXT_SCRIPT = """
+function walk(node) {
+	if (node.nodeType === 3) return node.nodeValue;
+	if (node.nodeName === 'IMG') return node.getAttribute('alt') || '';
+	if (node.nodeName === 'BR') return '\\n';
+	var out = '';
+	for (var i = 0; i < node.childNodes.length; i++) out += walk(node.childNodes[i]);
+	return out;
+}
+return walk(arguments[0]);
+"""
+
+
+def composed_text(driver, element):
+	try:
+		return driver.execute_script(COMPOSED_TEXT_SCRIPT, element) or ""
+	except Exception:
+		return ""
+
+
+def normalize_composed(text):
+	return re.sub(r"[\s\ufe0f]+", "", text or "")
+
+
+def text_matches(driver, element, message):
+	return normalize_composed(composed_text(driver, element)) == normalize_composed(message)
+
+
+def clear_composer(element):
+	try:
+		element.send_keys(Keys.CONTROL, "a")
+		element.send_keys(Keys.DELETE)
+	except Exception:
+		pass
+
+
+def type_text(element, message):
+	# Enter enviaría el mensaje a medias: los saltos de línea van con Shift+Enter
+	for index, line in enumerate(message.split("\n")):
+		if index:
+			element.send_keys(Keys.SHIFT, Keys.ENTER)
+		if line:
+			element.send_keys(line)
+
+
+def inject_text(driver, element, message, timeout=2):
+	for script in (PASTE_TEXT_SCRIPT, INSERT_TEXT_SCRIPT):
+		try:
+			driver.execute_script(script, element, message)
+			WebDriverWait(driver, timeout, poll_frequency=0.1).until(lambda d: text_matches(d, element, message))
+			return True
+		except Exception:
+			clear_composer(element)
+	try:
+		type_text(element, message)
+	except Exception:
+		return False
+	return text_matches(driver, element, message)
+
+
+def set_media_caption(driver, message):
+	if not message:
+		return False
+	caption = resolve_element(driver, 'caption', timeout=6, clickable=True)
+	if not caption:
+		return False
+	try:
+		caption.click()
+	except Exception:
+		pass
+	return inject_text(driver, caption, message)
+
+def ensure_message_sent(driver, chat_input, message):
+	if not message:
+		return True
+	try:
+		driver.execute_script("arguments[0].focus();", chat_input)
+	except Exception:
+		pass
+	# El texto puede venir precargado por la URL /send?text=; solo se reescribe si no coincide
+	if not text_matches(driver, chat_input, message):
+		if composed_text(driver, chat_input).strip():
+			clear_composer(chat_input)
+		if not inject_text(driver, chat_input, message):
+			return False
 	if click_send_button(driver):
 		return True
 	try:
@@ -447,12 +1182,194 @@ def normalize_file_links(data):
 	return []
 
 
-def render_message(template, name=None):
-	if not template:
-		return template
-	if not name:
-		name = ""
-	return template.replace("{name}", name).replace("{{name}}", name)
+DEFAULT_COUNTRY_CODE = os.getenv("DISPATCHER_DEFAULT_COUNTRY_CODE", "57")  # Default Colombia
+COUNTRY_CODES = {
+	'1', '7', '20', '27', '30', '31', '32', '33', '34', '36', '39', '40', '41', '43', '44', '45', '46', '47',
+	'48', '49', '51', '52', '53', '54', '55', '56', '57', '58', '60', '61', '62', '63', '64', '65', '66', '81',
+	'82', '84', '86', '90', '91', '92', '93', '94', '95', '98', '211', '212', '213', '216', '218', '220', '221',
+	'222', '223', '224', '225', '226', '227', '228', '229', '230', '231', '232', '233', '234', '235', '236',
+	'237', '238', '239', '240', '241', '242', '243', '244', '245', '246', '247', '248', '249', '250', '251',
+	'252', '253', '254', '255', '256', '257', '258', '260', '261', '262', '263', '264', '265', '266', '267',
+	'268', '269', '290', '291', '297', '298', '299', '350', '351', '352', '353', '354', '355', '356', '357',
+	'358', '359', '370', '371', '372', '373', '374', '375', '376', '377', '378', '379', '380', '381', '382',
+	'383', '385', '386', '387', '389', '420', '421', '423', '500', '501', '502', '503', '504', '505', '506',
+	'507', '508', '509', '590', '591', '592', '593', '594', '595', '596', '597', '598', '599', '670', '672',
+	'673', '674', '675', '676', '677', '678', '679', '680', '681', '682', '683', '685', '686', '687', '688',
+	'689', '690', '691', '692', '850', '852', '853', '855', '856', '880', '886', '960', '961', '962', '963',
+	'964', '965', '966', '967', '968', '970', '971', '972', '973', '974', '975', '976', '977', '992', '993',
+	'994', '995', '996', '998'
+}
+# Longitud del número nacional (sin indicativo) para los mercados más usados
+NATIONAL_LENGTHS = {
+	'1': (10,), '7': (10,), '33': (9,), '34': (9,), '39': (9, 10), '44': (10,), '49': (10, 11),
+	'51': (8, 9), '52': (10, 11), '53': (8,), '54': (10, 11), '55': (10, 11), '56': (9,), '57': (10,),
+	'58': (10,), '502': (8,), '503': (8,), '504': (8,), '505': (8,), '506': (8,), '507': (7, 8),
+	'591': (8,), '593': (8, 9), '595': (9,), '598': (8,)
+}
+# Prefijo troncal que se marca dentro del país y no forma parte del número internacional.
+# Los planes conocidos sin prefijo (Italia conserva el 0) no aparecen; los desconocidos asumen "0"
+TRUNK_PREFIXES = {
+	'7': '8', '33': '0', '44': '0', '49': '0', '51': '0', '53': '0', '54': '0', '55': '0', '58': '0',
+	'591': '0', '593': '0', '595': '0', '598': '0'
+}
+
+
+def split_country_code(digits):
+	# Los indicativos ITU no son prefijo unos de otros, así que basta con el primero que coincida
+	for size in (1, 2, 3):
+		if digits[:size] in COUNTRY_CODES:
+			return digits[:size], digits[size:]
+	return None, digits
+
+
+def normalize_phone(phone, country_code=None):
+	raw = str(phone or '').strip()
+	if not raw:
+		return None, 'error_phone_missing'
+	digits = re.sub(r"\D", "", raw)
+	if raw.startswith('+'):
+		code, national = split_country_code(digits)
+	elif raw.startswith('00'):
+		code, national = split_country_code(digits[2:])
+	else:
+		code = re.sub(r"\D", "", str(country_code or '')) or DEFAULT_COUNTRY_CODE
+		lengths = NATIONAL_LENGTHS.get(code)
+		trunk = TRUNK_PREFIXES.get(code, '' if lengths else '0')
+		national = digits[len(trunk):] if trunk and digits.startswith(trunk) else digits
+		# El número ya trae el indicativo aunque venga también en la columna de país
+		if lengths and national.startswith(code) and len(national) - len(code) in lengths and len(national) not in lengths:
+			national = national[len(code):]
+	if not code or code not in COUNTRY_CODES:
+		return None, 'error_invalid_country_code'
+	lengths = NATIONAL_LENGTHS.get(code)
+	if lengths and len(national) not in lengths:
+		return None, 'error_invalid_phone_length'
+	if not 8 <= len(code) + len(national) <= 15:
+		return None, 'error_invalid_phone_length'
+	return f"+{code}{national}", None
+
+
+def normalize_contacts(contacts, country_key='country_code', phone_key='phone'):
+	kept = []
+	rejected = []
+	seen = {}
+	for position, contact in enumerate(contacts):
+		row_index = contact.get('row_index', position)
+		canonical, error_code = normalize_phone(contact.get(phone_key), contact.get(country_key))
+		if error_code:
+			rejected.append({'row_index': row_index, 'phone': contact.get(phone_key), 'error_code': error_code})
+			continue
+		if canonical in seen:
+			rejected.append({
+				'row_index': row_index,
+				'phone': canonical,
+				'error_code': 'error_duplicate_phone',
+				'duplicate_of': seen[canonical]
+			})
+			continue
+		seen[canonical] = row_index
+		kept.append(dict(contact, phone=canonical))
+	return kept, summarize_normalization(len(contacts), rejected)
+
+
+def flag_contact_records(records, seen, offset=0, by_reason=None):
+	# En /upload no se descartan filas: se marcan para que el usuario pueda corregirlas.
+	# Con by_reason solo se cuentan los motivos, sin guardar una lista con cada fila rechazada
+	rejected = []
+	for position, record in enumerate(records, start=offset):
+		canonical, error_code = normalize_phone(record.get('phone'), record.get('country_code'))
+		# El número se guarda como entero: ocupa bastante menos que la cadena en archivos grandes
+		key = int(canonical[1:]) if canonical else None
+		if not error_code and key in seen:
+			error_code = 'error_duplicate_phone'
+			record['duplicate_of'] = seen[key]
+		if error_code:
+			record['phone_error'] = error_code
+			if by_reason is None:
+				rejected.append({'row_index': position, 'phone': record.get('phone'), 'error_code': error_code})
+			else:
+				by_reason[error_code] = by_reason.get(error_code, 0) + 1
+			continue
+		seen[key] = position
+		record['phone_e164'] = canonical
+	return rejected
+
+
+def summarize_normalization(total, rejected, include_rows=True):
+	by_reason = {}
+	for item in rejected:
+		by_reason[item['error_code']] = by_reason.get(item['error_code'], 0) + 1
+	summary = summarize_reason_counts(total, by_reason)
+	if include_rows:
+		summary['rejected'] = rejected
+	return summary
+
+
+def summarize_reason_counts(total, by_reason):
+	removed = sum(by_reason.values())
+	return {
+		'total': total,
+		'kept': total - removed,
+		'removed': removed,
+		'by_reason': by_reason
+	}
+
+
+INVALID_NUMBER_TTL = float(os.getenv("DISPATCHER_INVALID_TTL_DAYS", "30")) * 86400  # segundos
+invalid_numbers_lock = threading.Lock()
+invalid_numbers = None
+
+
+def load_invalid_numbers():
+	global invalid_numbers
+	if invalid_numbers is None:
+		try:
+			with open(data_path("invalid_numbers.json"), encoding="utf-8") as f:
+				invalid_numbers = json.load(f)
+		except Exception:
+			invalid_numbers = {}
+	return invalid_numbers
+
+
+def save_invalid_numbers():
+	now = time.time()
+	entries = load_invalid_numbers()
+	for phone in [p for p, entry in entries.items() if now - entry.get('checked_at', 0) > INVALID_NUMBER_TTL]:
+		entries.pop(phone, None)
+	try:
+		write_json_atomic(data_path("invalid_numbers.json"), entries)
+	except Exception:
+		app.logger.exception("Could not persist invalid number cache")
+
+
+def is_known_invalid(phone):
+	with invalid_numbers_lock:
+		entry = load_invalid_numbers().get(phone)
+	return bool(entry) and time.time() - entry.get('checked_at', 0) <= INVALID_NUMBER_TTL
+
+
+def remember_invalid_number(phone, reason):
+	with invalid_numbers_lock:
+		load_invalid_numbers()[phone] = {'checked_at': time.time(), 'reason': reason}
+		save_invalid_numbers()
+
+
+def forget_invalid_number(phone):
+	with invalid_numbers_lock:
+		if load_invalid_numbers().pop(phone, None):
+			save_invalid_numbers()
+
+
+def filter_known_invalid(contacts):
+	# Números que WhatsApp ya rechazó en campañas anteriores: no se vuelven a abrir en el navegador
+	kept = []
+	rejected = []
+	for contact in contacts:
+		if is_known_invalid(contact.get('phone')):
+			rejected.append({'row_index': contact.get('row_index'), 'error_code': 'error_phone_not_on_whatsapp'})
+		else:
+			kept.append(contact)
+	return kept, {'hits': len(rejected), 'misses': len(kept), 'rejected': rejected}
 
 
 def parse_request_payload():
@@ -484,56 +1401,514 @@ def _extract_drive_id(url):
 	return None
 
 
-def download_file_from_link(url, timeout=30):
-	if not url:
-		return None
-	drive_id = _extract_drive_id(url)
-	if drive_id:
+ATTACHMENT_CACHE_MAX_BYTES = int(float(os.getenv("DISPATCHER_ATTACHMENT_CACHE_MB", "1024")) * 1024 * 1024)
+ATTACHMENT_MAX_AGE = float(os.getenv("DISPATCHER_ATTACHMENT_MAX_AGE", "3600"))  # segundos sin revalidar
+ATTACHMENT_ORPHAN_AGE = 600  # segundos sin cambios antes de borrar blobs y .part que no están en el índice
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+PREFETCH_LOOKAHEAD = int(os.getenv("DISPATCHER_PREFETCH_LOOKAHEAD", "5"))  # filas por delante del envío
+PREFETCH_WORKERS = max(1, int(os.getenv("DISPATCHER_PREFETCH_WORKERS", "3")))
+attachment_cache_lock = threading.Lock()
+attachment_key_locks = {}
+attachment_index = None
+
+
+def attachment_cache_dir():
+	path = data_path("attachments")
+	ensure_profile_dir(path)
+	return path
+
+
+def load_attachment_index():
+	global attachment_index
+	if attachment_index is None:
 		try:
-			import gdown
-			tmp_file = tempfile.NamedTemporaryFile(delete=False)
-			tmp_file.close()
-			gdown.download(id=drive_id, output=tmp_file.name, quiet=True)
-			if os.path.isfile(tmp_file.name) and os.path.getsize(tmp_file.name) > 0:
-				return tmp_file.name
+			with open(data_path("attachments.json"), encoding="utf-8") as f:
+				attachment_index = json.load(f)
 		except Exception:
+			attachment_index = {}
+	return attachment_index
+
+
+def attachment_key_lock(key):
+	with attachment_cache_lock:
+		return attachment_key_locks.setdefault(key, threading.Lock())
+
+
+def safe_filename(name):
+	name = re.sub(r'[\\/:*?"<>|\x00-\x1f]', "_", name or "").strip(" .")
+	return name[:150] or "attachment"
+
+
+def filename_from_response(response, url):
+	disposition = response.headers.get("Content-Disposition") or ""
+	match = re.search(r"filename\*=(?:UTF-8'')?([^;]+)", disposition, re.IGNORECASE) or re.search(r'filename="?([^";]+)"?', disposition, re.IGNORECASE)
+	if match:
+		return safe_filename(unquote(match.group(1)))
+	return safe_filename(unquote(os.path.basename(urlparse(url).path)))
+
+
+def hash_file(path, algorithm=hashlib.sha256):
+	hasher = algorithm()
+	with open(path, "rb") as f:
+		for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b""):
+			hasher.update(chunk)
+	return hasher.hexdigest()
+
+
+def store_attachment(tmp_path, filename, digest):
+	# Direccionado por contenido: attachments/<sha256>/<nombre original>
+	dest_dir = os.path.join(attachment_cache_dir(), digest)
+	os.makedirs(dest_dir, exist_ok=True)
+	dest = os.path.join(dest_dir, filename)
+	if os.path.isfile(dest):
+		os.unlink(tmp_path)
+	else:
+		os.replace(tmp_path, dest)
+	return dest
+
+
+def fetch_url_attachment(url, timeout, entry=None):
+	headers = {}
+	if entry and entry.get('etag'):
+		headers['If-None-Match'] = entry['etag']
+	if entry and entry.get('last_modified'):
+		headers['If-Modified-Since'] = entry['last_modified']
+	with requests.get(url, timeout=timeout, stream=True, headers=headers) as response:
+		if response.status_code == 304 and entry:
+			return dict(entry)
+		if response.status_code != 200:
+			return None
+		hasher = hashlib.sha256()
+		size = 0
+		fd, tmp_path = tempfile.mkstemp(dir=attachment_cache_dir(), suffix=".part")
+		try:
+			with os.fdopen(fd, "wb") as f:
+				for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+					if chunk:
+						f.write(chunk)
+						hasher.update(chunk)
+						size += len(chunk)
+		except Exception:
+			os.unlink(tmp_path)
+			raise
+		if not size:
+			os.unlink(tmp_path)
 			return None
+		digest = hasher.hexdigest()
+		return {
+			'sha256': digest,
+			'path': store_attachment(tmp_path, filename_from_response(response, url), digest),
+			'size': size,
+			'etag': response.headers.get('ETag'),
+			'last_modified': response.headers.get('Last-Modified')
+		}
 
-	response = requests.get(url, timeout=timeout)
-	if response.status_code != 200 or not response.content:
+
+def fetch_drive_attachment(drive_id):
+	import gdown
+	tmp_dir = tempfile.mkdtemp(dir=attachment_cache_dir())
+	try:
+		# Con un directorio como destino gdown conserva el nombre original del archivo
+		output = gdown.download(id=drive_id, output=tmp_dir + os.sep, quiet=True)
+		if not output or not os.path.isfile(output) or not os.path.getsize(output):
+			return None
+		digest = hash_file(output)
+		size = os.path.getsize(output)
+		return {
+			'sha256': digest,
+			'path': store_attachment(output, safe_filename(os.path.basename(output)), digest),
+			'size': size
+		}
+	finally:
+		shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def remove_attachment_blob(path):
+	try:
+		os.unlink(path)
+		os.rmdir(os.path.dirname(path))
+	except Exception:
+		pass
+
+
+def newest_mtime(path):
+	# Un directorio de descarga en curso (gdown) cambia por dentro aunque el directorio no
+	mtimes = [os.path.getmtime(path)]
+	if os.path.isdir(path):
+		for name in os.listdir(path):
+			try:
+				mtimes.append(os.path.getmtime(os.path.join(path, name)))
+			except OSError:
+				pass
+	return max(mtimes)
+
+
+def sweep_untracked_attachments():
+	# Blobs sustituidos o huérfanos y .part abandonados: lo que no está en el índice no cuenta para el límite
+	tracked = {os.path.dirname(entry['path']) for entry in attachment_index.values()}
+	cache_dir = attachment_cache_dir()
+	now = time.time()
+	for name in os.listdir(cache_dir):
+		path = os.path.join(cache_dir, name)
+		if path in tracked:
+			continue
+		try:
+			if now - newest_mtime(path) < ATTACHMENT_ORPHAN_AGE:
+				continue
+			if os.path.isdir(path):
+				shutil.rmtree(path, ignore_errors=True)
+			elif name.endswith(".part"):
+				os.unlink(path)
+		except OSError:
+			pass
+
+
+def evict_attachments(keep_path):
+	sweep_untracked_attachments()
+	blobs = {}
+	for key, entry in attachment_index.items():
+		blob = blobs.setdefault(entry['path'], {'size': entry.get('size', 0), 'last_used': 0, 'keys': []})
+		blob['last_used'] = max(blob['last_used'], entry.get('last_used', 0))
+		blob['keys'].append(key)
+	total = sum(blob['size'] for blob in blobs.values())
+	now = time.time()
+	for path, blob in sorted(blobs.items(), key=lambda item: item[1]['last_used']):
+		if total <= ATTACHMENT_CACHE_MAX_BYTES:
+			break
+		# No se expulsa lo que se acaba de usar (puede estar adjuntándose en otra sesión)
+		if path == keep_path or now - blob['last_used'] < 60:
+			continue
+		remove_attachment_blob(path)
+		for key in blob['keys']:
+			attachment_index.pop(key, None)
+		total -= blob['size']
+
+
+def download_file_from_link(url, timeout=30):
+	if not url:
 		return None
-	with tempfile.NamedTemporaryFile(delete=False) as tmp_file:
-		tmp_file.write(response.content)
-		return tmp_file.name
+	drive_id = _extract_drive_id(url)
+	key = f"drive:{drive_id}" if drive_id else f"url:{url}"
+	with attachment_key_lock(key):
+		with attachment_cache_lock:
+			entry = load_attachment_index().get(key)
+		if entry and not os.path.isfile(entry['path']):
+			entry = None
+		previous_path = entry['path'] if entry else None
+		if not entry or time.time() - entry.get('fetched_at', 0) >= ATTACHMENT_MAX_AGE:
+			fetched = None
+			try:
+				if drive_id:
+					try:
+						fetched = fetch_drive_attachment(drive_id)
+					except Exception:
+						if not entry:
+							return None
+						raise
+				if not fetched:
+					fetched = fetch_url_attachment(url, timeout, entry)
+			except Exception:
+				if not entry:
+					raise
+				app.logger.warning("Revalidation of %s failed, using cached copy", url)
+			if fetched:
+				entry = dict(fetched, fetched_at=time.time())
+			elif not entry:
+				return None
+		entry['last_used'] = time.time()
+		with attachment_cache_lock:
+			attachment_index[key] = entry
+			# El contenido cambió al revalidar: el blob anterior sobra si ninguna otra clave lo usa
+			if previous_path and previous_path != entry['path'] and not any(other['path'] == previous_path for other in attachment_index.values()):
+				remove_attachment_blob(previous_path)
+			evict_attachments(entry['path'])
+			try:
+				write_json_atomic(data_path("attachments.json"), attachment_index)
+			except Exception:
+				app.logger.exception("Could not persist attachment cache index")
+		return entry['path']
 
 
 @app.route('/open_whatsapp', methods=['POST'])
 def open_whatsapp():
-	global driver_instance
+	data, _ = parse_request_payload()
+	session = get_session(data.get('session') or request.args.get('session'))
+	if not session:
+		return jsonify({'error': 'Session not found', 'error_code': 'error_session_not_found'}), 404
 	try:
-		driver = get_driver()
-		with driver_lock:
-			driver.get("https://web.whatsapp.com")
-		return jsonify({'status': 'opened'})
+		driver = get_driver(session)
+		with session['lock']:
+			driver.get(WHATSAPP_WEB_URL)
+		return jsonify({'status': 'opened', 'session': session['id']})
 	except Exception:
+		close_driver(session)
 		try:
-			if driver_instance:
-				driver_instance.quit()
-		except Exception:
-			pass
-		driver_instance = None
-		try:
-			driver = get_driver()
-			with driver_lock:
-				driver.get("https://web.whatsapp.com")
-			return jsonify({'status': 'opened'})
+			driver = get_driver(session)
+			with session['lock']:
+				driver.get(WHATSAPP_WEB_URL)
+			return jsonify({'status': 'opened', 'session': session['id']})
 		except Exception:
 			return jsonify({'error': 'Could not open WhatsApp session', 'error_code': 'error_whatsapp_open_failed'}), 500
 
+
+@app.route('/sessions', methods=['GET'])
+def list_sessions():
+	items = []
+	for session in sessions.values():
+		driver = session['driver']
+		items.append({
+			'id': session['id'],
+			'profile_dir': session['profile_dir'],
+			'port': session['port'],
+			'running': driver is not None,
+			'busy': session['lock'].locked(),
+			'logged_in': bool(driver) and time.monotonic() - login_state.get(driver, 0.0) < LOGIN_CHECK_TTL,
+			'state': session_state(session),
+			'error': session['error'],
+			'lean_mode': LEAN_MODE,
+			'memory': session['memory']
+		})
+	return jsonify({'sessions': items})
+
+
+@app.route('/ready', methods=['GET'])
+def ready():
+	states = {session['id']: session_state(session) for session in sessions.values()}
+	with browser_lock:
+		browser = dict(browser_manifest) if browser_manifest else None
+		resolving = browser_resolving
+	payload = {
+		'ready': 'ready' in states.values(),
+		'sessions': states,
+		'browser': browser,
+		'browser_state': 'resolving' if resolving else ('resolved' if browser else 'unresolved')
+	}
+	return jsonify(payload), 200 if payload['ready'] else 503
+
 @app.route('/')
 def index():
 	return render_template('index.html')
 
+# Mapear columnas a las esperadas: country_code, phone, name, message, file_link
+CONTACT_COLUMNS = {
+	'country_code': ('country_code', 'codigo_pais', 'country code', 'código de país'),
+	'phone': ('phone', 'telefono', 'número', 'numero', 'teléfono', 'phone_number'),
+	'name': ('name', 'nombre'),
+	'message': ('message', 'mensaje'),
+	'file_link': ('file_link', 'archivo', 'file link', 'link archivo')
+}
+
+
+def resolve_contact_columns(columns):
+	labels = [str(col).lower().strip() for col in columns]
+	mapping = {}
+	for key, possible_names in CONTACT_COLUMNS.items():
+		names = {name.lower() for name in possible_names}
+		mapping[key] = next((position for position, label in enumerate(labels) if label in names), None)
+	# El resto de columnas se conserva como variables de plantilla ({ciudad}, {deuda}...)
+	used = set(mapping.values())
+	for position, column in enumerate(columns):
+		key = template_key(column)
+		if position not in used and key and key not in mapping and not key.startswith('unnamed'):
+			mapping[key] = position
+	return mapping
+
+
+def map_contact_records(df, mapping):
+	# Conversión por columnas: una sola pasada vectorizada en lugar de df.iterrows()
+	empty = [''] * len(df)
+	columns = {}
+	for key, position in mapping.items():
+		if position is None:
+			columns[key] = empty
+			continue
+		columns[key] = df.iloc[:, position].fillna('').astype(str).tolist()
+	keys = list(columns)
+	return [dict(zip(keys, values)) for values in zip(*columns.values())]
+
+
+# Plantillas: {columna}, {{columna}} y {columna|valor por defecto}
+# \{ y \} escriben llaves literales
+TEMPLATE_VARIABLE = re.compile(r"\\([{}])|\{\{\s*(\w+)\s*(?:\|([^{}]*))?\}\}|\{(\w+)(?:\|([^{}]*))?\}")
+TEMPLATE_ALIASES = {
+	re.sub(r"\W+", "_", alias.lower()).strip("_"): key
+	for key, aliases in CONTACT_COLUMNS.items()
+	for alias in aliases
+}
+# Columnas base del contacto: siempre existen aunque la fila no las traiga (valor "")
+TEMPLATE_BUILTINS = ('name', 'phone')
+
+
+def template_key(name):
+	key = re.sub(r"\W+", "_", str(name).strip().lower()).strip("_")
+	return TEMPLATE_ALIASES.get(key, key)
+
+
+@lru_cache(maxsize=256)
+def compile_template(template):
+	# Se analiza una sola vez: texto literal y (variable, defecto) alternados
+	parts = []
+	position = 0
+	for match in TEMPLATE_VARIABLE.finditer(template):
+		if match.start() > position:
+			parts.append(template[position:match.start()])
+		if match.group(1):
+			parts.append(match.group(1))
+		elif match.group(2):
+			parts.append((template_key(match.group(2)), match.group(3)))
+		else:
+			parts.append((template_key(match.group(4)), match.group(5)))
+		position = match.end()
+	if position < len(template):
+		parts.append(template[position:])
+	return tuple(parts)
+
+
+def template_variables(compiled):
+	return sorted({part[0] for part in compiled if isinstance(part, tuple)})
+
+
+def contact_template_values(contact):
+	values = {}
+	variables = contact.get('variables')
+	if isinstance(variables, dict):
+		for key, value in variables.items():
+			values[template_key(key)] = value
+	for key, value in contact.items():
+		if key != 'variables' and isinstance(value, (str, int, float)):
+			values[template_key(key)] = value
+	return values
+
+
+def fill_template(compiled, values):
+	# Valor vacío -> defecto si lo hay; columna propia inexistente sin defecto -> variable faltante
+	chunks = []
+	missing = []
+	for part in compiled:
+		if isinstance(part, str):
+			chunks.append(part)
+			continue
+		key, default = part
+		value = values.get(key)
+		if value is None or value == '':
+			if default is not None:
+				value = default
+			elif key not in values and key not in TEMPLATE_BUILTINS:
+				missing.append(key)
+				continue
+			else:
+				value = ''
+		chunks.append(str(value))
+	return "".join(chunks), missing
+
+
+def render_contact_message(template, contact):
+	if not template:
+		return template, []
+	return fill_template(compile_template(template), contact_template_values(contact))
+
+
+def prerender_messages(messages, global_message):
+	# Texto final y URL codificada de cada fila antes de encolar: el envío no hace trabajo de cadenas
+	ready = []
+	rejected = []
+	variables = set()
+	for msg in messages:
+		template = global_message or msg.get('message')
+		if not template:
+			ready.append(msg)
+			continue
+		compiled = compile_template(template)
+		variables.update(template_variables(compiled))
+		text, missing = fill_template(compiled, contact_template_values(msg))
+		if missing:
+			rejected.append({
+				'row_index': msg.get('row_index'),
+				'phone': msg.get('phone'),
+				'error_code': 'error_template_missing_variable',
+				'missing': missing
+			})
+			continue
+		ready.append(dict(msg, text=text, text_url=quote(text)))
+	return ready, {'variables': sorted(variables), 'rejected': rejected}
+
+
+UPLOAD_CHUNK_SIZE = 5000
+
+
+def cell_to_text(value):
+	if value is None:
+		return ''
+	if isinstance(value, float) and value.is_integer():
+		return str(int(value))
+	return str(value)
+
+
+def iter_csv_contact_chunks(path, chunk_size):
+	import pandas as pd
+	mapping = None
+	for df in pd.read_csv(path, dtype=str, chunksize=chunk_size):
+		if mapping is None:
+			mapping = resolve_contact_columns(df.columns)
+		yield map_contact_records(df, mapping)
+
+
+def iter_xlsx_contact_chunks(path, chunk_size):
+	import openpyxl
+	# Modo read_only: openpyxl recorre la hoja sin cargarla completa en memoria
+	workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+	try:
+		rows = workbook.active.iter_rows(values_only=True)
+		header = next(rows, None)
+		if header is None:
+			return
+		mapping = resolve_contact_columns([cell_to_text(col) for col in header])
+		batch = []
+		for row in rows:
+			item = {}
+			for key, position in mapping.items():
+				value = row[position] if position is not None and position < len(row) else None
+				item[key] = cell_to_text(value)
+			batch.append(item)
+			if len(batch) >= chunk_size:
+				yield batch
+				batch = []
+		if batch:
+			yield batch
+	finally:
+		workbook.close()
+
+
+def stream_contact_import(path, filename, chunk_size):
+	started = time.perf_counter()
+	chunks = iter_csv_contact_chunks(path, chunk_size) if filename.endswith('.csv') else iter_xlsx_contact_chunks(path, chunk_size)
+	offset = 0
+	seen = {}
+	by_reason = {}
+	try:
+		for chunk in chunks:
+			flag_contact_records(chunk, seen, offset, by_reason)
+			yield json.dumps({'offset': offset, 'data': chunk}) + "\n"
+			offset += len(chunk)
+	except Exception as e:
+		app.logger.exception("Streaming import of %s failed", filename)
+		yield json.dumps({'error': str(e), 'offset': offset}) + "\n"
+		return
+	finally:
+		try:
+			os.unlink(path)
+		except Exception:
+			pass
+	import_seconds = round(time.perf_counter() - started, 3)
+	app.logger.info("Imported %d contacts from %s in %.3fs", offset, filename, import_seconds)
+	yield json.dumps({
+		'done': True,
+		'total': offset,
+		'import_seconds': import_seconds,
+		'normalization': summarize_reason_counts(offset, by_reason)
+	}) + "\n"
+
+
 @app.route('/upload', methods=['POST'])
 def upload_csv():
 	try:
@@ -547,40 +1922,46 @@ def upload_csv():
 	if file.filename == '':
 		return jsonify({'error': 'No selected file'})
 	if file and (file.filename.endswith('.csv') or file.filename.endswith('.xlsx')):
+		if request.args.get('stream') == '1' or request.form.get('stream') == '1':
+			chunk_size = request.args.get('chunk_size', UPLOAD_CHUNK_SIZE, type=int) or UPLOAD_CHUNK_SIZE
+			# El archivo se vuelca a disco para poder leerlo por partes después de cerrar la petición
+			path = save_uploaded_files([file])[0]
+			return Response(
+				stream_with_context(stream_contact_import(path, file.filename, max(1, chunk_size))),
+				mimetype='application/x-ndjson'
+			)
+		started = time.perf_counter()
+		# Todo como texto: evita que los teléfonos se lean como float ("3001234567.0")
 		if file.filename.endswith('.csv'):
-			df = pd.read_csv(file)
+			df = pd.read_csv(file, dtype=str)
 		else:
-			df = pd.read_excel(file)
-		# Mapear columnas a las esperadas: country_code, phone, name, message, file_link
-		column_mapping = {
-			'country_code': ['country_code', 'codigo_pais', 'country code', 'código de país'],
-			'phone': ['phone', 'telefono', 'número', 'numero', 'teléfono', 'phone_number'],
-			'name': ['name', 'nombre'],
-			'message': ['message', 'mensaje'],
-			'file_link': ['file_link', 'archivo', 'file link', 'link archivo']
-		}
-		mapped_data = []
-		for _, row in df.iterrows():
-			item = {}
-			for key, possible_names in column_mapping.items():
-				for col in df.columns:
-					if col.lower().strip() in [p.lower() for p in possible_names]:
-						item[key] = str(row[col]) if pd.notna(row[col]) else ''
-						break
-				if key not in item:
-					item[key] = ''
-			mapped_data.append(item)
-		return jsonify({'data': mapped_data})
+			df = pd.read_excel(file, dtype=str)
+		mapping = resolve_contact_columns(df.columns)
+		mapped_data = map_contact_records(df, mapping)
+		by_reason = {}
+		flag_contact_records(mapped_data, {}, by_reason=by_reason)
+		import_seconds = round(time.perf_counter() - started, 3)
+		app.logger.info("Imported %d contacts from %s in %.3fs", len(mapped_data), file.filename, import_seconds)
+		return jsonify({
+			'data': mapped_data,
+			'import_seconds': import_seconds,
+			'normalization': summarize_reason_counts(len(mapped_data), by_reason)
+		})
 	return jsonify({'error': 'Invalid file'})
 
 @app.route('/send', methods=['POST'])
 def send():
 	data, _ = parse_request_payload()
 	phone = data.get('phone')
-	message_template = data.get('message')
-	name = data.get('name')
 	row_index = data.get('row_index')
-	message = render_message(message_template, name)
+	message, missing = render_contact_message(data.get('message'), data)
+	if missing:
+		return jsonify({
+			'error': 'Missing template variables',
+			'error_code': 'error_template_missing_variable',
+			'missing_variables': missing,
+			'row_index': row_index
+		})
 	if not phone or not message:
 		return jsonify({
 			'error': 'Phone and message required',
@@ -588,51 +1969,89 @@ def send():
 			'row_index': row_index
 		})
     
-	# Si el teléfono no comienza con +, asumimos que es local y necesitamos country_code
-	if not phone.startswith('+'):
-		country_code = data.get('country_code', '57')  # Default Colombia
-		phone = f"+{country_code}{phone}"
+	# Si el teléfono no comienza con +, se completa con country_code y se valida antes de abrir el navegador
+	phone, error_code = normalize_phone(phone, data.get('country_code'))
+	if error_code:
+		return jsonify({'error': error_code, 'error_code': error_code, 'row_index': row_index})
+	if not data.get('recheck_invalid') and is_known_invalid(phone):
+		return jsonify({
+			'error': 'error_phone_not_on_whatsapp',
+			'error_code': 'error_phone_not_on_whatsapp',
+			'row_index': row_index,
+			'cached': True
+		})
     
+	session = get_session(data.get('session'))
+	if not session:
+		return jsonify({
+			'error': 'Session not found',
+			'error_code': 'error_session_not_found',
+			'row_index': row_index
+		})
 	try:
-		driver = get_driver()
+		driver = get_driver(session)
 	except Exception as e:
 		return jsonify({'error': str(e), 'row_index': row_index})
-	with driver_lock:
+	with session['lock']:
 		if not ensure_logged_in(driver):
 			return jsonify({
 				'error': 'WhatsApp no está autenticado. Abre WhatsApp Web en el navegador del servidor y escanea el QR.',
 				'error_code': 'error_whatsapp_not_authenticated',
 				'row_index': row_index
 			})
+		timings = begin_row_timings()
 		try:
-			encoded_message = quote(message)
-			driver.get(f"https://web.whatsapp.com/send?phone={phone}&text={encoded_message}&app_absent=0")
-			chat_input = wait_for_chat_input(driver, 20)
+			open_started = time.monotonic()
+			with timed_stage('chat_open'):
+				chat_input, open_mode = open_chat(driver, phone, message, data.get('chat_open_mode'), quote(message))
+			open_seconds = round(time.monotonic() - open_started, 3)
 			try:
 				chat_input.click()
 			except Exception:
 				pass
 
-			if not ensure_message_sent(driver, chat_input, message):
+			with timed_stage('message_send'):
+				message_sent = ensure_message_sent(driver, chat_input, message)
+			if not message_sent:
 				raise Exception("error_send_message")
+			forget_invalid_number(phone)
+			record_send(session['id'], time.time())
 			time.sleep(0.2)
-			return jsonify({'status': 'Message sent', 'row_index': row_index})
+			count_message('sent')
+			return jsonify({
+				'status': 'Message sent',
+				'row_index': row_index,
+				'session': session['id'],
+				'open_mode': open_mode,
+				'open_seconds': open_seconds,
+				'timings': timings
+			})
 		except Exception as e:
 			error_key = str(e)
-			error_payload = {'error': error_key, 'row_index': row_index}
+			if error_key == 'error_phone_not_on_whatsapp':
+				remember_invalid_number(phone, error_key)
+			else:
+				invalidate_login_state(driver)
+			error_payload = {'error': error_key, 'row_index': row_index, 'session': session['id'], 'timings': timings}
 			if error_key.startswith('error_'):
 				error_payload['error_code'] = error_key
+			count_message('error', error_payload.get('error_code'))
 			return jsonify(error_payload)
 		finally:
-			pass
+			end_row_timings()
 
-@app.route('/send_all', methods=['POST'])
-def send_all():
-	data, uploaded_files = parse_request_payload()
-	messages = data.get('contacts', data.get('messages', []))
-	global_message = data.get('message')
-	global_file_links = normalize_file_links(data)
-	upload_paths = save_uploaded_files(uploaded_files)
+CAMPAIGN_FINISHED_STATES = ('completed', 'failed', 'interrupted')
+CAMPAIGN_RESUMABLE_STATES = ('failed', 'interrupted')
+CAMPAIGN_RETENTION = 50
+
+campaigns_lock = threading.Lock()
+campaigns = {}
+idempotency_key_locks = {}
+campaign_queue = queue.Queue()
+campaign_worker = None
+
+
+def parse_intervals(data):
 	min_interval = data.get('min_interval', 1)  # segundos
 	max_interval = data.get('max_interval', 2)  # segundos
 	try:
@@ -645,122 +2064,1305 @@ def send_all():
 		max_interval = min_interval
 	min_interval = max(0.5, min_interval)
 	max_interval = max(0.5, max_interval)
+	return min_interval, max_interval
+
+
+HOURLY_LIMIT = int(os.getenv("DISPATCHER_HOURLY_LIMIT", "0"))  # 0 = sin límite
+DAILY_LIMIT = int(os.getenv("DISPATCHER_DAILY_LIMIT", "0"))
+SEND_WINDOWS = os.getenv("DISPATCHER_SEND_WINDOWS", "")  # p. ej. 08:00-12:00|14:00-19:00
+PACING_BURST = int(os.getenv("DISPATCHER_PACING_BURST", "1"))
+send_history_lock = threading.Lock()
+send_history = None
+
+
+def parse_send_windows(raw):
+	if isinstance(raw, str):
+		raw = raw.split("|")
+	windows = []
+	for item in raw or []:
+		item = str(item).strip()
+		if not item:
+			continue
+		match = re.fullmatch(r"(\d{1,2}):(\d{2})\s*-\s*(\d{1,2}):(\d{2})", item)
+		if not match:
+			raise Exception("error_invalid_send_window")
+		start_h, start_m, end_h, end_m = (int(part) for part in match.groups())
+		if start_h > 24 or end_h > 24 or start_m > 59 or end_m > 59:
+			raise Exception("error_invalid_send_window")
+		windows.append((start_h * 60 + start_m, end_h * 60 + end_m))
+	return windows
+
+
+def parse_pacing(data):
+	def limit(key, default):
+		try:
+			return max(0, int(data.get(key, default) or 0))
+		except Exception:
+			return default
+	return {
+		'hourly_limit': limit('hourly_limit', HOURLY_LIMIT),
+		'daily_limit': limit('daily_limit', DAILY_LIMIT),
+		'burst': max(1, limit('burst', PACING_BURST)),
+		'windows': parse_send_windows(data.get('send_windows', SEND_WINDOWS))
+	}
+
+
+RETRY_ATTEMPTS = int(os.getenv("DISPATCHER_RETRY_ATTEMPTS", "3"))  # intentos por fila, incluido el primero
+RETRY_BACKOFF = float(os.getenv("DISPATCHER_RETRY_BACKOFF", "30"))  # segundos antes del primer reintento
+RETRY_BACKOFF_MAX = float(os.getenv("DISPATCHER_RETRY_BACKOFF_MAX", "600"))
+# Errores que no cambian al reintentar: el número, la plantilla o la fila en sí están mal
+PERMANENT_ERRORS = {
+	'error_phone_not_on_whatsapp',
+	'error_phone_missing',
+	'error_invalid_country_code',
+	'error_invalid_phone_length',
+	'error_duplicate_phone',
+	'error_template_missing_variable',
+	'error_already_sent',
+	'error_send_interrupted'
+}
+
+
+def parse_retry(data):
+	try:
+		attempts = int(data.get('retry_attempts', RETRY_ATTEMPTS))
+	except Exception:
+		attempts = RETRY_ATTEMPTS
 	try:
-		driver = get_driver()
+		backoff = float(data.get('retry_backoff', RETRY_BACKOFF))
+	except Exception:
+		backoff = RETRY_BACKOFF
+	return {'attempts': min(10, max(1, attempts)), 'backoff': max(0.0, backoff), 'backoff_max': RETRY_BACKOFF_MAX}
+
+
+def classify_error(error_code):
+	return 'permanent' if error_code in PERMANENT_ERRORS else 'transient'
+
+
+def retry_delay(retry, attempt):
+	# Espera exponencial: backoff, 2x, 4x... hasta backoff_max
+	return round(min(retry['backoff_max'], retry['backoff'] * 2 ** (attempt - 1)), 3)
+
+
+def load_send_history():
+	global send_history
+	if send_history is None:
+		try:
+			with open(data_path("send_history.json"), encoding="utf-8") as f:
+				send_history = json.load(f)
+		except Exception:
+			send_history = {}
+	return send_history
+
+
+def record_send(session_id, sent_at):
+	with send_history_lock:
+		history = load_send_history()
+		# Solo interesa el último día para las cuotas
+		stamps = [stamp for stamp in history.get(session_id, []) if sent_at - stamp < 86400]
+		stamps.append(sent_at)
+		history[session_id] = stamps
+		try:
+			write_json_atomic(data_path("send_history.json"), history)
+		except Exception:
+			app.logger.exception("Could not persist send history")
+
+
+def quota_delay(session_id, pacing, now):
+	with send_history_lock:
+		stamps = list(load_send_history().get(session_id, []))
+	delay = 0
+	for limit, period in ((pacing['hourly_limit'], 3600), (pacing['daily_limit'], 86400)):
+		if not limit:
+			continue
+		recent = sorted(stamp for stamp in stamps if now - stamp < period)
+		if len(recent) >= limit:
+			delay = max(delay, recent[len(recent) - limit] + period - now)
+	return delay
+
+
+def window_delay(windows):
+	if not windows:
+		return 0
+	current = datetime.now()
+	minute = current.hour * 60 + current.minute + current.second / 60
+	waits = []
+	for start, end in windows:
+		if (start <= minute < end) if start <= end else (minute >= start or minute < end):
+			return 0
+		waits.append((start - minute) % 1440)
+	return min(waits) * 60
+
+
+def create_pacer(session, settings):
+	pacing = settings['pacing']
+	return {
+		'session_id': session['id'],
+		'pacing': pacing,
+		'min_interval': settings['min_interval'],
+		'max_interval': settings['max_interval'],
+		'interval': random.uniform(settings['min_interval'], settings['max_interval']),
+		'tokens': float(pacing['burst']),
+		'updated': time.monotonic()
+	}
+
+
+def refill_pacer(pacer):
+	now = time.monotonic()
+	if pacer['interval'] > 0:
+		pacer['tokens'] = min(pacer['pacing']['burst'], pacer['tokens'] + (now - pacer['updated']) / pacer['interval'])
+	else:
+		pacer['tokens'] = float(pacer['pacing']['burst'])
+	pacer['updated'] = now
+
+
+def next_send_delay(pacer):
+	# El intervalo se mide entre inicios de envío: lo que tardó Selenium ya cuenta como espera
+	refill_pacer(pacer)
+	delays = [
+		('rate', (1 - pacer['tokens']) * pacer['interval'] if pacer['tokens'] < 1 else 0),
+		('quota', quota_delay(pacer['session_id'], pacer['pacing'], time.time())),
+		('window', window_delay(pacer['pacing']['windows']))
+	]
+	return max(delays, key=lambda item: item[1])
+
+
+def wait_for_send_slot(campaign, pacer):
+	started = time.monotonic()
+	while True:
+		reason, delay = next_send_delay(pacer)
+		if delay <= 0:
+			break
+		with campaign['condition']:
+			campaign['pacing']['waiting'][pacer['session_id']] = {'reason': reason, 'until': time.time() + delay}
+			if reason != 'rate':
+				campaign['pacing'][f"{reason}_waits"] += 1
+			campaign['condition'].notify_all()
+		time.sleep(min(delay, 60))
+	waited = time.monotonic() - started
+	observe_stage('pacing', waited)
+	with campaign['condition']:
+		campaign['pacing']['waiting'].pop(pacer['session_id'], None)
+		campaign['pacing']['wait_seconds'] += waited
+	return round(waited, 3)
+
+
+def consume_send_slot(pacer, sent):
+	# Sin recargar: el token se descuenta desde que se concedió el turno, antes del envío
+	pacer['tokens'] -= 1
+	# Nuevo intervalo aleatorio para el siguiente token
+	pacer['interval'] = random.uniform(pacer['min_interval'], pacer['max_interval'])
+	if sent:
+		record_send(pacer['session_id'], time.time())
+
+
+CAMPAIGN_TERMINAL_ROW_STATES = ('sent', 'error', 'skipped')
+RESUME_ON_START = os.getenv("DISPATCHER_RESUME_ON_START", "0") == "1"
+ledger_lock = threading.Lock()
+ledger_connection = None
+
+
+def get_ledger():
+	global ledger_connection
+	if ledger_connection is None:
+		connection = sqlite3.connect(data_path("campaigns.db"), check_same_thread=False, isolation_level=None)
+		connection.execute("PRAGMA journal_mode=WAL")
+		connection.execute("PRAGMA synchronous=NORMAL")
+		connection.executescript("""
+			CREATE TABLE IF NOT EXISTS campaigns (
+				id TEXT PRIMARY KEY,
+				idempotency_key TEXT,
+				status TEXT NOT NULL,
+				created_at REAL NOT NULL,
+				started_at REAL,
+				finished_at REAL,
+				error TEXT,
+				error_code TEXT,
+				payload TEXT NOT NULL
+			);
+			CREATE INDEX IF NOT EXISTS campaigns_idempotency_key ON campaigns (idempotency_key);
+			CREATE TABLE IF NOT EXISTS row_events (
+				seq INTEGER PRIMARY KEY AUTOINCREMENT,
+				campaign_id TEXT NOT NULL,
+				position INTEGER,
+				phone TEXT,
+				state TEXT NOT NULL,
+				result TEXT,
+				recorded_at REAL NOT NULL
+			);
+			CREATE INDEX IF NOT EXISTS row_events_campaign ON row_events (campaign_id, seq);
+		""")
+		# Al arrancar ninguna campaña está en curso: las que quedaron a medias se marcan como interrumpidas
+		connection.execute("UPDATE campaigns SET status = 'interrupted' WHERE status IN ('queued', 'running')")
+		ledger_connection = connection
+	return ledger_connection
+
+
+def ledger_write(sql, params):
+	try:
+		with ledger_lock:
+			get_ledger().execute(sql, params)
+		return True
+	except Exception:
+		app.logger.exception("Could not write campaign ledger")
+		return False
+
+
+def ledger_create_campaign(campaign):
+	payload = {
+		'contacts': campaign['contacts'],
+		'settings': campaign['settings'],
+		'total': campaign['total'],
+		'normalization': campaign['normalization'],
+		'negative_cache': campaign['negative_cache'],
+		'idempotency': campaign['idempotency'],
+		'template': campaign['template']
+	}
+	ledger_write(
+		"INSERT INTO campaigns (id, idempotency_key, status, created_at, payload) VALUES (?, ?, ?, ?, ?)",
+		(campaign['id'], campaign['idempotency']['key'], campaign['status'], campaign['created_at'], json.dumps(payload))
+	)
+
+
+def ledger_update_campaign(campaign):
+	ledger_write(
+		"UPDATE campaigns SET status = ?, started_at = ?, finished_at = ?, error = ?, error_code = ? WHERE id = ?",
+		(campaign['status'], campaign['started_at'], campaign['finished_at'], campaign['error'], campaign['error_code'], campaign['id'])
+	)
+
+
+def ledger_row_event(campaign, position, phone, state, result=None):
+	return ledger_write(
+		"INSERT INTO row_events (campaign_id, position, phone, state, result, recorded_at) VALUES (?, ?, ?, ?, ?, ?)",
+		(campaign['id'], position, phone, state, json.dumps(result) if result is not None else None, time.time())
+	)
+
+
+def ledger_delivered_phones(idempotency_key):
+	with ledger_lock:
+		rows = get_ledger().execute(
+			"SELECT DISTINCT e.phone FROM row_events e JOIN campaigns c ON c.id = e.campaign_id "
+			"WHERE c.idempotency_key = ? AND e.state = 'sent' AND e.phone IS NOT NULL",
+			(idempotency_key,)
+		).fetchall()
+	return {row[0] for row in rows}
+
+
+def load_campaign_from_ledger(campaign_id):
+	with ledger_lock:
+		connection = get_ledger()
+		row = connection.execute(
+			"SELECT id, status, created_at, started_at, finished_at, error, error_code, payload FROM campaigns WHERE id = ?",
+			(campaign_id,)
+		).fetchone()
+		if not row:
+			return None
+		events = connection.execute(
+			"SELECT position, phone, state, result FROM row_events WHERE campaign_id = ? ORDER BY seq",
+			(campaign_id,)
+		).fetchall()
+	payload = json.loads(row[7])
+	campaign = build_campaign(payload['contacts'], payload['settings'], payload['idempotency'])
+	campaign.update({
+		'id': row[0],
+		'status': row[1],
+		'created_at': row[2],
+		'started_at': row[3],
+		'finished_at': row[4],
+		'error': row[5],
+		'error_code': row[6],
+		'total': payload['total'],
+		'normalization': payload['normalization'],
+		'template': payload.get('template', campaign['template'])
+	})
+	campaign['negative_cache'] = dict(payload['negative_cache'], added=0)
+	for position, phone, state, result in events:
+		if state in CAMPAIGN_TERMINAL_ROW_STATES:
+			record_campaign_result(campaign, json.loads(result), position, persist=False)
+		elif state == 'recycle':
+			campaign['recycles'].append(json.loads(result))
+		elif state == 'retry':
+			# Al reanudar la fila vuelve a la cola con los intentos que ya llevaba
+			record_campaign_retry(campaign, json.loads(result), position, phone, persist=False)
+		elif position is not None:
+			campaign['in_flight'][position] = phone
+	return campaign
+
+
+def build_campaign(contacts, settings, idempotency=None):
+	return {
+		'id': uuid.uuid4().hex,
+		'status': 'queued',
+		'created_at': time.time(),
+		'started_at': None,
+		'finished_at': None,
+		'total': len(contacts),
+		'counts': {'sent': 0, 'error': 0, 'skipped': 0},
+		'open_timing': {},
+		'stage_timing': {},
+		'prefetch': {'files': 0, 'ready': 0, 'fetch_seconds': 0.0, 'wait_seconds': 0.0},
+		'pacing': {'wait_seconds': 0.0, 'quota_waits': 0, 'window_waits': 0, 'waiting': {}},
+		'recycles': [],
+		'retries': {'scheduled': 0, 'recovered': 0, 'failed': 0},
+		'retry_queue': [],
+		'attempts': {},
+		'halted': None,
+		'template': {'variables': [], 'missing': 0},
+		'sessions': [],
+		'normalization': None,
+		'negative_cache': {'hits': 0, 'misses': len(contacts), 'added': 0},
+		'idempotency': idempotency or {'key': None, 'already_sent': 0},
+		'results': [],
+		'done_positions': set(),
+		'in_flight': {},
+		'error': None,
+		'error_code': None,
+		'contacts': contacts,
+		'settings': settings,
+		'condition': threading.Condition()
+	}
+
+
+def register_campaign(campaign):
+	with campaigns_lock:
+		campaign = campaigns.setdefault(campaign['id'], campaign)
+		finished = [c for c in campaigns.values() if c['status'] in CAMPAIGN_FINISHED_STATES]
+		finished.sort(key=lambda c: c['finished_at'] or 0)
+		for old in finished[:max(0, len(finished) - CAMPAIGN_RETENTION)]:
+			campaigns.pop(old['id'], None)
+	return campaign
+
+
+def create_campaign(contacts, settings, normalization=None, negative_cache=None, idempotency=None, rendering=None):
+	negative_cache = negative_cache or {'hits': 0, 'misses': len(contacts), 'rejected': []}
+	idempotency = idempotency or {'key': None, 'rejected': []}
+	rendering = rendering or {'variables': [], 'rejected': []}
+	rejected = (normalization or {}).get('rejected', []) + negative_cache['rejected'] + idempotency['rejected'] + rendering['rejected']
+	campaign = build_campaign(contacts, settings, {'key': idempotency['key'], 'already_sent': len(idempotency['rejected'])})
+	campaign['template'] = {'variables': rendering['variables'], 'missing': len(rendering['rejected'])}
+	campaign['total'] = len(contacts) + len(rejected)
+	campaign['normalization'] = summarize_normalization(campaign['total'], (normalization or {}).get('rejected', []), include_rows=False)
+	campaign['negative_cache'] = {'hits': negative_cache['hits'], 'misses': negative_cache['misses'], 'added': 0}
+	ledger_create_campaign(campaign)
+	# Las filas descartadas por la normalización quedan como omitidas sin pasar por el navegador
+	for item in rejected:
+		result = {
+			'row_index': item['row_index'],
+			'status': 'skipped',
+			'error': item['error_code'],
+			'error_code': item['error_code']
+		}
+		if item['error_code'] == 'error_phone_not_on_whatsapp':
+			result['cached'] = True
+		if item.get('missing'):
+			result['missing_variables'] = item['missing']
+		record_campaign_result(campaign, result, phone=item.get('phone'))
+	return register_campaign(campaign)
+
+
+def get_campaign(campaign_id):
+	with campaigns_lock:
+		campaign = campaigns.get(campaign_id)
+	if campaign:
+		return campaign
+	# Campañas antiguas o de una ejecución anterior se reconstruyen desde el registro en disco
+	try:
+		campaign = load_campaign_from_ledger(campaign_id)
+	except Exception:
+		app.logger.exception("Could not load campaign %s from ledger", campaign_id)
+		return None
+	return register_campaign(campaign) if campaign else None
+
+
+def find_active_campaign(idempotency_key):
+	with campaigns_lock:
+		for campaign in campaigns.values():
+			if campaign['idempotency']['key'] == idempotency_key and campaign['status'] not in CAMPAIGN_FINISHED_STATES:
+				return campaign
+	return None
+
+
+def resume_campaign(campaign):
+	with campaign['condition']:
+		if campaign['status'] not in CAMPAIGN_RESUMABLE_STATES:
+			raise Exception("error_campaign_not_resumable")
+		if any(not os.path.isfile(path) for path in campaign['settings']['upload_paths']):
+			raise Exception("error_resume_missing_uploads")
+		campaign['error'] = None
+		campaign['error_code'] = None
+		campaign['finished_at'] = None
+		campaign['halted'] = None
+		in_flight = list(campaign['in_flight'].items())
+	# No se sabe si WhatsApp llegó a enviar estas filas: se marcan como error en lugar de repetirlas
+	for position, phone in in_flight:
+		record_campaign_result(campaign, {
+			'row_index': campaign['contacts'][position].get('row_index'),
+			'status': 'error',
+			'error': 'error_send_interrupted',
+			'error_code': 'error_send_interrupted'
+		}, position, phone)
+	set_campaign_status(campaign, 'queued')
+	ensure_campaign_worker()
+	campaign_queue.put(campaign)
+	return campaign
+
+
+def resume_interrupted_campaigns():
+	with ledger_lock:
+		campaign_ids = [row[0] for row in get_ledger().execute(
+			"SELECT id FROM campaigns WHERE status = 'interrupted' ORDER BY created_at"
+		).fetchall()]
+	for campaign_id in campaign_ids:
+		campaign = get_campaign(campaign_id)
+		try:
+			resume_campaign(campaign)
+		except Exception as e:
+			app.logger.warning("Campaign %s was not resumed: %s", campaign_id, e)
+
+
+def campaign_summary(campaign):
+	with campaign['condition']:
+		summary = {
+			'campaign_id': campaign['id'],
+			'status': campaign['status'],
+			'created_at': campaign['created_at'],
+			'started_at': campaign['started_at'],
+			'finished_at': campaign['finished_at'],
+			'total': campaign['total'],
+			'processed': sum(campaign['counts'].values()),
+			'counts': dict(campaign['counts']),
+			'sessions': list(campaign['sessions']),
+			'normalization': campaign['normalization'],
+			'negative_cache': dict(campaign['negative_cache']),
+			'open_timing': {
+				mode: {
+					'count': timing['count'],
+					'avg_seconds': round(timing['total_seconds'] / timing['count'], 3)
+				}
+				for mode, timing in campaign['open_timing'].items()
+			},
+			'stage_timing': {
+				stage: {
+					'count': timing['count'],
+					'avg_seconds': round(timing['total_seconds'] / timing['count'], 3),
+					'max_seconds': round(timing['max_seconds'], 3),
+					'total_seconds': round(timing['total_seconds'], 3)
+				}
+				for stage, timing in campaign['stage_timing'].items()
+			},
+			'prefetch': {
+				'files': campaign['prefetch']['files'],
+				'ready': campaign['prefetch']['ready'],
+				'fetch_seconds': round(campaign['prefetch']['fetch_seconds'], 3),
+				'wait_seconds': round(campaign['prefetch']['wait_seconds'], 3)
+			},
+			'idempotency': dict(campaign['idempotency']),
+			'recycles': list(campaign['recycles']),
+			'retries': dict(campaign['retries'], pending=len(campaign['retry_queue'])),
+			'template': dict(campaign['template']),
+			'pacing': {
+				'wait_seconds': round(campaign['pacing']['wait_seconds'], 3),
+				'quota_waits': campaign['pacing']['quota_waits'],
+				'window_waits': campaign['pacing']['window_waits'],
+				'waiting': {
+					session_id: {'reason': wait['reason'], 'until': round(wait['until'], 3)}
+					for session_id, wait in campaign['pacing']['waiting'].items()
+				}
+			}
+		}
+		if campaign['error']:
+			summary['error'] = campaign['error']
+		if campaign['error_code']:
+			summary['error_code'] = campaign['error_code']
+	return summary
+
+
+def set_campaign_status(campaign, status, error=None, error_code=None):
+	with campaign['condition']:
+		campaign['status'] = status
+		if status == 'running':
+			campaign['started_at'] = time.time()
+		if status in CAMPAIGN_FINISHED_STATES:
+			campaign['finished_at'] = time.time()
+		if error:
+			campaign['error'] = error
+		if error_code:
+			campaign['error_code'] = error_code
+		ledger_update_campaign(campaign)
+		campaign['condition'].notify_all()
+
+
+def record_campaign_result(campaign, result, position=None, phone=None, persist=True):
+	if persist:
+		if not ledger_row_event(campaign, position, phone, result['status'], result):
+			halt_campaign(campaign, 'error_ledger_unavailable')
+		count_message(result['status'], result.get('error_code'))
+	with campaign['condition']:
+		if position is not None:
+			campaign['done_positions'].add(position)
+			campaign['in_flight'].pop(position, None)
+		campaign['results'].append(result)
+		status = result.get('status')
+		if status in campaign['counts']:
+			campaign['counts'][status] += 1
+		if result.get('attempts', 1) > 1:
+			campaign['retries']['recovered' if status == 'sent' else 'failed'] += 1
+		if result.get('error_code') == 'error_phone_not_on_whatsapp' and not result.get('cached'):
+			campaign['negative_cache']['added'] += 1
+		open_mode = result.get('open_mode')
+		if open_mode:
+			timing = campaign['open_timing'].setdefault(open_mode, {'count': 0, 'total_seconds': 0.0})
+			timing['count'] += 1
+			timing['total_seconds'] += result.get('open_seconds') or 0.0
+		for stage, seconds in result.get('timings', {}).items():
+			timing = campaign['stage_timing'].setdefault(stage, {'count': 0, 'total_seconds': 0.0, 'max_seconds': 0.0})
+			timing['count'] += 1
+			timing['total_seconds'] += seconds
+			timing['max_seconds'] = max(timing['max_seconds'], seconds)
+		for attachment in result.get('attachments', []):
+			prefetch = campaign['prefetch']
+			prefetch['files'] += 1
+			prefetch['ready'] += 1 if attachment['ready'] else 0
+			prefetch['fetch_seconds'] += attachment['fetch_seconds']
+			prefetch['wait_seconds'] += attachment['wait_seconds']
+		campaign['condition'].notify_all()
+
+
+def halt_campaign(campaign, error_code):
+	# Sin registro en disco no se puede reanudar ni evitar duplicados: no se envían más filas
+	with campaign['condition']:
+		campaign['halted'] = campaign['halted'] or error_code
+		campaign['condition'].notify_all()
+
+
+def record_campaign_retry(campaign, result, position, phone, due=None, persist=True):
+	# Un fallo transitorio no es resultado final: la fila queda pendiente hasta agotar los intentos
+	if persist:
+		if not ledger_row_event(campaign, position, phone, 'retry', result):
+			halt_campaign(campaign, 'error_ledger_unavailable')
+		count_message('retrying', result.get('error_code'))
+	with campaign['condition']:
+		campaign['in_flight'].pop(position, None)
+		campaign['attempts'][position] = result.get('attempts', 1)
+		if due is not None:
+			heapq.heappush(campaign['retry_queue'], (due, position, campaign['contacts'][position]))
+		campaign['retries']['scheduled'] += 1
+		campaign['results'].append(result)
+		campaign['condition'].notify_all()
+
+
+def row_file_links(msg, settings):
+	return settings['file_links'] or normalize_file_links(msg)
+
+
+def fetch_attachment_timed(file_link):
+	started = time.monotonic()
+	try:
+		path, error = download_file_from_link(file_link), None
 	except Exception as e:
-		return jsonify({'error': str(e)})
-	with driver_lock:
-		if not ensure_logged_in(driver):
-			return jsonify({
-				'error': 'WhatsApp no está autenticado. Abre WhatsApp Web en el navegador del servidor y escanea el QR.',
-				'error_code': 'error_whatsapp_not_authenticated'
-			})
+		path, error = None, str(e)
+	fetch_seconds = time.monotonic() - started
+	observe_stage('attachment_download', fetch_seconds)
+	return {'link': file_link, 'path': path, 'error': error, 'fetch_seconds': round(fetch_seconds, 3)}
+
+
+def create_prefetcher(contacts, settings, done_positions=()):
+	# Al reanudar solo se miran las filas pendientes; la anticipación se cuenta sobre ellas
+	pending = [position for position in range(len(contacts)) if position not in done_positions]
+	return {
+		'executor': ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="prefetch"),
+		'contacts': contacts,
+		'settings': settings,
+		'pending': pending,
+		'ranks': {position: rank for rank, position in enumerate(pending)},
+		'cursor': 0,
+		'futures': {},
+		'lock': threading.Lock()
+	}
 
-		if not global_message and not any(msg.get('message') for msg in messages):
-			return jsonify({'error': 'Message required', 'error_code': 'error_message_required'})
 
-		results = []
+def advance_prefetch(prefetcher, position):
+	# Encola las descargas de las próximas filas mientras la actual se envía
+	with prefetcher['lock']:
+		rank = prefetcher['ranks'].get(position)
+		if rank is None:
+			return
+		end = min(len(prefetcher['pending']), rank + 1 + PREFETCH_LOOKAHEAD)
+		while prefetcher['cursor'] < end:
+			msg = prefetcher['contacts'][prefetcher['pending'][prefetcher['cursor']]]
+			for file_link in row_file_links(msg, prefetcher['settings']):
+				if file_link not in prefetcher['futures']:
+					prefetcher['futures'][file_link] = prefetcher['executor'].submit(fetch_attachment_timed, file_link)
+			prefetcher['cursor'] += 1
+
+
+def resolve_row_attachments(prefetcher, file_links):
+	file_paths = []
+	timing = []
+	for file_link in file_links:
+		wait_started = time.monotonic()
+		if prefetcher:
+			with prefetcher['lock']:
+				future = prefetcher['futures'].get(file_link)
+				if not future:
+					future = prefetcher['futures'][file_link] = prefetcher['executor'].submit(fetch_attachment_timed, file_link)
+			ready = future.done()
+			fetched = future.result()
+		else:
+			ready = False
+			fetched = fetch_attachment_timed(file_link)
+		timing.append({
+			'link': file_link,
+			'ready': ready,
+			'fetch_seconds': fetched['fetch_seconds'],
+			'wait_seconds': round(time.monotonic() - wait_started, 3)
+		})
+		if fetched['error']:
+			if prefetcher:
+				# No se guarda el fallo: un reintento de la fila vuelve a descargar
+				with prefetcher['lock']:
+					if prefetcher['futures'].get(file_link) is future:
+						prefetcher['futures'].pop(file_link)
+			app.logger.warning("Attachment download failed for %s: %s", file_link, fetched['error'])
+			raise Exception("error_attachment_download")
+		if fetched['path']:
+			file_paths.append(fetched['path'])
+	return file_paths, timing
+
+
+def send_campaign_row(driver, msg, settings, file_paths_global, prefetcher=None):
+	phone = msg.get('phone')
+	# Texto y URL ya renderizados al crear la campaña (prerender_messages)
+	message = msg.get('text')
+	encoded_message = msg.get('text_url')
+	if message is None:
+		message, _ = render_contact_message(settings['message'] or msg.get('message'), msg)
+		encoded_message = None
+	file_links = row_file_links(msg, settings)
+	row_index = msg.get('row_index')
+	if not phone or not message:
+		return {'row_index': row_index, 'status': 'skipped'}
+	if not phone.startswith('+'):
+		phone, error_code = normalize_phone(phone, msg.get('country_code'))
+		if error_code:
+			return {'row_index': row_index, 'status': 'skipped', 'error': error_code, 'error_code': error_code}
+
+	attachment_timing = []
+	delivered = None
+	try:
+		# Los adjuntos se resuelven antes de abrir el chat para no dejar el navegador esperando
+		file_paths = file_paths_global[:]
+		if file_links and not file_paths:
+			with timed_stage('attachment_wait'):
+				file_paths, attachment_timing = resolve_row_attachments(prefetcher, file_links)
+
+		open_started = time.monotonic()
+		with timed_stage('chat_open'):
+			chat_input, open_mode = open_chat(driver, phone, message, settings.get('chat_open_mode'), encoded_message)
+		open_seconds = round(time.monotonic() - open_started, 3)
+		try:
+			chat_input.click()
+		except Exception:
+			pass
+
+		if file_paths:
+			with timed_stage('attach_files'):
+				attached = attach_files(driver, file_paths)
+			if not attached:
+				raise Exception("error_attach_files")
+			with timed_stage('caption'):
+				caption_set = set_media_caption(driver, message)
+			with timed_stage('send_click'):
+				clicked = click_send_button(driver, timeout=30)
+			if not clicked:
+				raise Exception("error_send_attachments")
+			delivered = 'attachments'
+			time.sleep(0.2)
+			if not caption_set:
+				chat_input = wait_for_chat_input(driver, 15)
+				with timed_stage('message_send'):
+					message_sent = ensure_message_sent(driver, chat_input, message)
+				if not message_sent:
+					raise Exception("error_send_message")
+		else:
+			with timed_stage('message_send'):
+				message_sent = ensure_message_sent(driver, chat_input, message)
+			if not message_sent:
+				raise Exception("error_send_message")
+		if settings.get('recheck_invalid'):
+			forget_invalid_number(phone)
+		time.sleep(0.2)
+		result = {'row_index': row_index, 'status': 'sent', 'open_mode': open_mode, 'open_seconds': open_seconds}
+		if attachment_timing:
+			result['attachments'] = attachment_timing
+		return result
+	except Exception as e:
+		error_key = str(e)
+		if error_key == 'error_phone_not_on_whatsapp':
+			remember_invalid_number(phone, error_key)
+		else:
+			invalidate_login_state(driver)
+		app.logger.warning("Error sending to %s: %s", phone, error_key)
+		result = {'row_index': row_index, 'status': 'error', 'error': error_key}
+		if error_key.startswith('error_'):
+			result['error_code'] = error_key
+		elif isinstance(e, TimeoutException):
+			result['error_code'] = 'error_timeout'
+		result['error_class'] = classify_error(result.get('error_code'))
+		if delivered:
+			# Los adjuntos ya llegaron: reintentar la fila los enviaría otra vez
+			result['delivered'] = delivered
+			result['error_class'] = 'permanent'
+		if attachment_timing:
+			result['attachments'] = attachment_timing
+		return result
+
+
+def prepare_campaign_sessions(settings):
+	requested = settings.get('sessions') or list(sessions.keys())
+	ready = []
+	errors = []
+	for session_id in requested:
+		session = sessions.get(session_id)
+		if not session:
+			errors.append((session_id, 'Session not found', 'error_session_not_found'))
+			continue
+		try:
+			driver = get_driver(session)
+		except Exception as e:
+			errors.append((session_id, str(e), None))
+			continue
+		with session['lock']:
+			if ensure_logged_in(driver):
+				ready.append(session)
+			else:
+				errors.append((
+					session_id,
+					'WhatsApp no está autenticado. Abre WhatsApp Web en el navegador del servidor y escanea el QR.',
+					'error_whatsapp_not_authenticated'
+				))
+	return ready, errors
+
+
+RECYCLE_HEAP_MB = float(os.getenv("WHATSAPP_RECYCLE_HEAP_MB", "1024"))  # 0 = sin límite
+RECYCLE_LATENCY_FACTOR = float(os.getenv("WHATSAPP_RECYCLE_LATENCY_FACTOR", "2.5"))
+RECYCLE_ERROR_RATE = float(os.getenv("WHATSAPP_RECYCLE_ERROR_RATE", "0.5"))
+RECYCLE_WINDOW = max(1, int(os.getenv("WHATSAPP_RECYCLE_WINDOW", "20")))  # filas
+RECYCLE_SAMPLE_EVERY = 10  # filas entre muestras de memoria
+RECYCLE_RELAUNCH_ATTEMPTS = 3
+RECYCLE_RELAUNCH_BACKOFF = 5  # segundos antes del segundo intento; se duplica en cada uno
+
+
+def reset_browser_health(session):
+	session['health'] = {
+		'rows': 0,
+		'latencies': deque(maxlen=RECYCLE_WINDOW),
+		'errors': deque(maxlen=RECYCLE_WINDOW),
+		'baseline': None
+	}
+
+
+def recycle_reason(session, result):
+	# Se evalúa entre filas; devuelve el motivo para reciclar el navegador o None
+	health = session.get('health')
+	if health is None:
+		reset_browser_health(session)
+		health = session['health']
+	driver = session['driver']
+	failed = result['status'] in ('error', 'retrying')
+	if failed and driver and not driver_process_alive(driver):
+		return 'driver_dead'
+	health['rows'] += 1
+	latency = (result.get('timings') or {}).get('row_total')
+	if latency is not None:
+		health['latencies'].append(latency)
+	health['errors'].append(failed and result.get('error_code') != 'error_phone_not_on_whatsapp')
+	window_full = len(health['errors']) == RECYCLE_WINDOW
+	if health['baseline'] is None and len(health['latencies']) == RECYCLE_WINDOW:
+		health['baseline'] = sum(health['latencies']) / len(health['latencies'])
+	elif health['baseline'] and RECYCLE_LATENCY_FACTOR and window_full:
+		average = sum(health['latencies']) / max(1, len(health['latencies']))
+		if average > health['baseline'] * RECYCLE_LATENCY_FACTOR:
+			return 'latency'
+	if RECYCLE_ERROR_RATE and window_full and sum(health['errors']) / RECYCLE_WINDOW >= RECYCLE_ERROR_RATE:
+		return 'error_rate'
+	if RECYCLE_HEAP_MB and health['rows'] % RECYCLE_SAMPLE_EVERY == 0:
+		sample = sample_session_memory(session)
+		if sample and sample['js_heap_used'] > RECYCLE_HEAP_MB * 1024 * 1024:
+			return 'memory'
+	return None
+
+
+def recycle_browser(campaign, session, reason, after_row):
+	# Mismo perfil: la sesión de WhatsApp sigue vinculada y no hace falta escanear el QR
+	started = time.monotonic()
+	memory = session['memory']
+	event = {'session': session['id'], 'reason': reason, 'after_row': after_row, 'at': time.time()}
+	if memory:
+		event['js_heap_used'] = memory['js_heap_used']
+	close_driver(session)
+	for attempt in range(RECYCLE_RELAUNCH_ATTEMPTS):
+		if attempt:
+			time.sleep(RECYCLE_RELAUNCH_BACKOFF * 2 ** (attempt - 1))
+		try:
+			driver = get_driver(session)
+			event['logged_in'] = ensure_logged_in(driver, force=True)
+			event.pop('error', None)
+			break
+		except Exception as e:
+			event['logged_in'] = False
+			event['error'] = str(e)
+	event['attempts'] = attempt + 1
+	event['seconds'] = round(time.monotonic() - started, 3)
+	observe_stage('browser_recycle', event['seconds'])
+	reset_browser_health(session)
+	app.logger.info("Recycled browser of session %s (%s) in %.1fs", session['id'], reason, event['seconds'])
+	ledger_row_event(campaign, None, None, 'recycle', event)
+	with campaign['condition']:
+		campaign['recycles'].append(event)
+		campaign['condition'].notify_all()
+	return session['driver']
+
+
+def next_campaign_row(campaign, rows):
+	# Los reintentos vencidos se intercalan con las filas nuevas; agotadas estas, se espera al siguiente
+	condition = campaign['condition']
+	while True:
+		with condition:
+			if campaign['halted']:
+				return None
+			retries = campaign['retry_queue']
+			if retries and retries[0][0] <= time.time():
+				_due, position, msg = heapq.heappop(retries)
+				return position, msg
+		try:
+			return rows.get_nowait()
+		except queue.Empty:
+			pass
+		with condition:
+			retries = campaign['retry_queue']
+			if not retries:
+				return None
+			condition.wait(timeout=min(60, max(0, retries[0][0] - time.time())))
+
+
+def run_campaign_shard(campaign, session, rows, file_paths_global, prefetcher=None):
+	settings = campaign['settings']
+	retry = settings.get('retry') or parse_retry({})
+	# Cada sesión toma filas de la cola compartida y respeta su propio ritmo y cuotas
+	pacer = create_pacer(session, settings)
+	# El candado de la sesión solo cubre el trabajo con el navegador: las esperas de ritmo,
+	# ventana y cuota no bloquean a /send ni a /status sobre la misma sesión
+	while True:
+		item = next_campaign_row(campaign, rows)
+		if item is None:
+			with session['lock']:
+				sample_session_memory(session)
+			return
+		position, msg = item
+		if prefetcher:
+			advance_prefetch(prefetcher, position)
+		pacing_seconds = wait_for_send_slot(campaign, pacer)
+		# El aviso de envío se escribe antes de abrir el chat: si no queda registro, la fila no se envía
+		if not ledger_row_event(campaign, position, msg.get('phone'), 'sending'):
+			halt_campaign(campaign, 'error_ledger_unavailable')
+			return
+		with campaign['condition']:
+			campaign['in_flight'][position] = msg.get('phone')
+			attempt = campaign['attempts'][position] = campaign['attempts'].get(position, 0) + 1
+		with session['lock']:
+			driver = session['driver']
+			begin_row_timings()
+			try:
+				with timed_stage('row_total'):
+					result = send_campaign_row(driver, msg, settings, file_paths_global, prefetcher)
+			finally:
+				timings = end_row_timings()
+		if timings and result['status'] != 'skipped':
+			result['timings'] = timings
+		result['session'] = session['id']
+		if result['status'] != 'skipped':
+			consume_send_slot(pacer, result['status'] == 'sent')
+			result['pacing_seconds'] = pacing_seconds
+			result['attempts'] = attempt
+		if result['status'] == 'error' and result.get('error_class') == 'transient' and attempt < retry['attempts']:
+			result['status'] = 'retrying'
+			result['retry_in'] = retry_delay(retry, attempt)
+			record_campaign_retry(campaign, result, position, msg.get('phone'), time.time() + result['retry_in'])
+		else:
+			record_campaign_result(campaign, result, position, msg.get('phone'))
+		if result['status'] == 'skipped':
+			continue
+		with session['lock']:
+			reason = recycle_reason(session, result)
+			if reason and not recycle_browser(campaign, session, reason, msg.get('row_index')):
+				# Chrome no volvió a arrancar: las demás sesiones siguen con la cola
+				app.logger.error("Session %s stopped: browser could not be relaunched", session['id'])
+				return
+
+
+def fail_pending_rows(campaign, rows, error_code):
+	# Filas que ninguna sesión pudo enviar: se cierran con un error explícito en lugar de quedar sin estado
+	pending = []
+	while True:
+		try:
+			pending.append(rows.get_nowait())
+		except queue.Empty:
+			break
+	with campaign['condition']:
+		pending.extend((position, msg) for _due, position, msg in campaign['retry_queue'])
+		campaign['retry_queue'] = []
+	for position, msg in pending:
+		record_campaign_result(campaign, {
+			'row_index': msg.get('row_index'),
+			'status': 'error',
+			'error': error_code,
+			'error_code': error_code,
+			'error_class': 'permanent',
+			'attempts': campaign['attempts'].get(position, 0)
+		}, position, msg.get('phone'))
+
+
+def run_campaign(campaign):
+	set_campaign_status(campaign, 'running')
+	settings = campaign['settings']
+	upload_paths = settings['upload_paths']
+	prefetcher = None
+	try:
+		ready, errors = prepare_campaign_sessions(settings)
+		if not ready:
+			_session_id, error, error_code = errors[0] if errors else (None, 'No WhatsApp sessions available', None)
+			set_campaign_status(campaign, 'failed', error=error, error_code=error_code)
+			return
+		with campaign['condition']:
+			campaign['sessions'] = [session['id'] for session in ready]
 
 		file_paths_global = upload_paths[:]
-		download_paths = []
-		if global_file_links and not file_paths_global:
-			for file_link in global_file_links:
+		if settings['file_links'] and not file_paths_global:
+			for file_link in settings['file_links']:
 				file_path = download_file_from_link(file_link)
 				if file_path:
 					file_paths_global.append(file_path)
-					download_paths.append(file_path)
-
-		for msg in messages:
-			phone = msg.get('phone')
-			message_template = global_message or msg.get('message')
-			message = render_message(message_template, msg.get('name'))
-			file_links = global_file_links or normalize_file_links(msg)
-			row_index = msg.get('row_index')
-			if not phone or not message:
-				results.append({'row_index': row_index, 'status': 'skipped'})
-				continue
-			if not phone.startswith('+'):
-				country_code = msg.get('country_code', '57')
-				phone = f"+{country_code}{phone}"
 
-			try:
-				encoded_message = quote(message)
-				driver.get(f"https://web.whatsapp.com/send?phone={phone}&text={encoded_message}&app_absent=0")
-				chat_input = wait_for_chat_input(driver, 20)
-				try:
-					chat_input.click()
-				except Exception:
-					pass
-
-				file_paths = file_paths_global[:]
-				if file_links and not file_paths:
-					for file_link in file_links:
-						file_path = download_file_from_link(file_link)
-						if not file_path:
-							continue
-						file_paths.append(file_path)
-
-				if file_paths:
-					if not attach_files(driver, file_paths):
-						raise Exception("error_attach_files")
-					caption_set = set_media_caption(driver, message)
-					if not click_send_button(driver, timeout=30):
-						raise Exception("error_send_attachments")
-					time.sleep(0.2)
-					if not caption_set:
-						chat_input = wait_for_chat_input(driver, 15)
-						if not ensure_message_sent(driver, chat_input, message):
-							raise Exception("error_send_message")
-				else:
-					if not ensure_message_sent(driver, chat_input, message):
-						raise Exception("error_send_message")
-				time.sleep(0.2)
-				results.append({'row_index': row_index, 'status': 'sent'})
-			except Exception as e:
-				error_key = str(e)
-				print(f"Error sending to {phone}: {error_key}")
-				result = {'row_index': row_index, 'status': 'error', 'error': error_key}
-				if error_key.startswith('error_'):
-					result['error_code'] = error_key
-				results.append(result)
-
-			interval = random.uniform(min_interval, max_interval)
-			time.sleep(interval)
-
-	try:
-		return jsonify({'status': f'Sent {len(messages)} messages with random intervals', 'results': results})
+		if not file_paths_global:
+			prefetcher = create_prefetcher(campaign['contacts'], settings, campaign['done_positions'])
+		rows = queue.Queue()
+		with campaign['condition']:
+			# Al reanudar las filas con reintento pendiente vuelven a la cola principal
+			campaign['retry_queue'] = []
+		for position, msg in enumerate(campaign['contacts']):
+			# Al reanudar solo quedan las filas sin estado final en el registro
+			if position not in campaign['done_positions']:
+				rows.put((position, msg))
+		shards = [
+			threading.Thread(
+				target=run_campaign_shard,
+				args=(campaign, session, rows, file_paths_global, prefetcher),
+				name=f"campaign-{campaign['id'][:8]}-{session['id']}",
+				daemon=True
+			)
+			for session in ready
+		]
+		for shard in shards:
+			shard.start()
+		for shard in shards:
+			shard.join()
+		if campaign['halted']:
+			# Las filas pendientes siguen sin estado: al reanudar se envían cuando el registro vuelva a funcionar
+			set_campaign_status(campaign, 'failed', error='Campaign ledger unavailable', error_code=campaign['halted'])
+			return
+		fail_pending_rows(campaign, rows, 'error_browser_unavailable')
+		set_campaign_status(campaign, 'completed')
+	except Exception as e:
+		app.logger.exception("Campaign %s failed", campaign['id'])
+		set_campaign_status(campaign, 'failed', error=str(e))
 	finally:
+		if prefetcher:
+			prefetcher['executor'].shutdown(wait=False, cancel_futures=True)
 		for path in upload_paths:
 			try:
 				os.unlink(path)
 			except Exception:
 				pass
-		for path in download_paths:
-			try:
-				os.unlink(path)
-			except Exception:
-				pass
+
+
+def campaign_worker_loop():
+	while True:
+		campaign = campaign_queue.get()
+		try:
+			run_campaign(campaign)
+		finally:
+			campaign_queue.task_done()
+
+
+def ensure_campaign_worker():
+	global campaign_worker
+	with campaigns_lock:
+		if campaign_worker and campaign_worker.is_alive():
+			return
+		campaign_worker = threading.Thread(target=campaign_worker_loop, name="campaign-worker", daemon=True)
+		campaign_worker.start()
+
+
+SERVER_THREADS = max(4, int(os.getenv("DISPATCHER_THREADS", "16")))
+# Cada stream SSE ocupa un hilo de waitress toda la campaña: se reservan 4 para el resto de rutas
+EVENT_STREAM_LIMIT = SERVER_THREADS - 4
+event_streams_lock = threading.Lock()
+event_streams = 0
+
+
+def acquire_event_stream():
+	global event_streams
+	with event_streams_lock:
+		if event_streams >= EVENT_STREAM_LIMIT:
+			return False
+		event_streams += 1
+		return True
+
+
+def release_event_stream():
+	global event_streams
+	with event_streams_lock:
+		event_streams -= 1
+
+
+def format_sse(event, data, event_id=None):
+	lines = []
+	if event_id is not None:
+		lines.append(f"id: {event_id}")
+	lines.append(f"event: {event}")
+	lines.append(f"data: {json.dumps(data)}")
+	return "\n".join(lines) + "\n\n"
+
+
+def idempotency_key_lock(key):
+	with campaigns_lock:
+		return idempotency_key_locks.setdefault(key, threading.Lock())
+
+
+@app.route('/send_all', methods=['POST'])
+def send_all():
+	data, uploaded_files = parse_request_payload()
+	idempotency_key = data.get('idempotency_key') or request.headers.get('Idempotency-Key')
+	if not idempotency_key:
+		return queue_send_all(data, uploaded_files, None)
+	# Comprobar la campaña activa, filtrar los ya enviados y crear la nueva van juntos para la misma clave
+	with idempotency_key_lock(idempotency_key):
+		return queue_send_all(data, uploaded_files, idempotency_key)
+
+
+def queue_send_all(data, uploaded_files, idempotency_key):
+	messages = data.get('contacts', data.get('messages', []))
+	global_message = data.get('message')
+	if not global_message and not any(msg.get('message') for msg in messages):
+		return jsonify({'error': 'Message required', 'error_code': 'error_message_required'})
+	try:
+		pacing = parse_pacing(data)
+	except Exception as e:
+		return jsonify({'error': 'Invalid sending window', 'error_code': str(e)}), 400
+	if idempotency_key:
+		active = find_active_campaign(idempotency_key)
+		if active:
+			return jsonify({
+				'error': 'A campaign with this idempotency key is already running',
+				'error_code': 'error_campaign_in_progress',
+				'campaign_id': active['id']
+			}), 409
+	global_file_links = normalize_file_links(data)
+	min_interval, max_interval = parse_intervals(data)
+	requested_sessions = data.get('sessions')
+	if isinstance(requested_sessions, str):
+		requested_sessions = [requested_sessions]
+	unknown = [s for s in requested_sessions or [] if s not in sessions]
+	if unknown:
+		return jsonify({'error': f"Session not found: {', '.join(unknown)}", 'error_code': 'error_session_not_found'}), 404
+
+	messages, normalization = normalize_contacts(messages)
+	negative_cache = None
+	if not data.get('recheck_invalid'):
+		messages, negative_cache = filter_known_invalid(messages)
+	idempotency = None
+	if idempotency_key:
+		# Reenviar la misma campaña no repite los números que ya recibieron el mensaje
+		delivered = ledger_delivered_phones(idempotency_key)
+		idempotency = {'key': idempotency_key, 'rejected': []}
+		pending = []
+		for msg in messages:
+			if msg['phone'] in delivered:
+				idempotency['rejected'].append({'row_index': msg.get('row_index'), 'phone': msg['phone'], 'error_code': 'error_already_sent'})
+			else:
+				pending.append(msg)
+		messages = pending
+	messages, rendering = prerender_messages(messages, global_message)
+	if rendering['rejected'] and not messages:
+		missing = sorted({key for item in rendering['rejected'] for key in item['missing']})
+		return jsonify({
+			'error': f"Missing template variables: {', '.join(missing)}",
+			'error_code': 'error_template_missing_variable',
+			'missing_variables': missing
+		}), 400
+	upload_paths = save_uploaded_files(uploaded_files)
+	campaign = create_campaign(messages, {
+		'message': global_message,
+		'file_links': global_file_links,
+		'upload_paths': upload_paths,
+		'min_interval': min_interval,
+		'max_interval': max_interval,
+		'pacing': pacing,
+		'retry': parse_retry(data),
+		'chat_open_mode': data.get('chat_open_mode'),
+		'sessions': requested_sessions,
+		'recheck_invalid': bool(data.get('recheck_invalid'))
+	}, normalization, negative_cache, idempotency, rendering)
+	ensure_campaign_worker()
+	campaign_queue.put(campaign)
+	return jsonify({
+		'status': 'queued',
+		'campaign_id': campaign['id'],
+		'total': campaign['total'],
+		'normalization': normalization,
+		'status_url': f"/campaigns/{campaign['id']}",
+		'results_url': f"/campaigns/{campaign['id']}/results",
+		'events_url': f"/campaigns/{campaign['id']}/events"
+	}), 202
+
+
+@app.route('/campaigns', methods=['GET'])
+def list_campaigns():
+	# Las campañas interrumpidas en una ejecución anterior se listan para poder reanudarlas
+	with ledger_lock:
+		interrupted = [row[0] for row in get_ledger().execute("SELECT id FROM campaigns WHERE status = 'interrupted'").fetchall()]
+	for campaign_id in interrupted:
+		get_campaign(campaign_id)
+	with campaigns_lock:
+		items = list(campaigns.values())
+	items.sort(key=lambda c: c['created_at'], reverse=True)
+	return jsonify({'campaigns': [campaign_summary(c) for c in items]})
+
+
+@app.route('/campaigns/<campaign_id>', methods=['GET'])
+def campaign_status(campaign_id):
+	campaign = get_campaign(campaign_id)
+	if not campaign:
+		return jsonify({'error': 'Campaign not found', 'error_code': 'error_campaign_not_found'}), 404
+	return jsonify(campaign_summary(campaign))
+
+
+@app.route('/campaigns/<campaign_id>/resume', methods=['POST'])
+def campaign_resume(campaign_id):
+	campaign = get_campaign(campaign_id)
+	if not campaign:
+		return jsonify({'error': 'Campaign not found', 'error_code': 'error_campaign_not_found'}), 404
+	try:
+		resume_campaign(campaign)
+	except Exception as e:
+		return jsonify({'error': 'Campaign cannot be resumed', 'error_code': str(e)}), 409
+	return jsonify({
+		'status': 'queued',
+		'campaign_id': campaign['id'],
+		'total': campaign['total'],
+		'status_url': f"/campaigns/{campaign['id']}",
+		'results_url': f"/campaigns/{campaign['id']}/results",
+		'events_url': f"/campaigns/{campaign['id']}/events"
+	}), 202
+
+
+@app.route('/campaigns/<campaign_id>/results', methods=['GET'])
+def campaign_results(campaign_id):
+	campaign = get_campaign(campaign_id)
+	if not campaign:
+		return jsonify({'error': 'Campaign not found', 'error_code': 'error_campaign_not_found'}), 404
+	offset = max(0, request.args.get('offset', 0, type=int) or 0)
+	limit = request.args.get('limit', type=int)
+	with campaign['condition']:
+		end = len(campaign['results']) if not limit or limit < 0 else offset + limit
+		results = campaign['results'][offset:end]
+	payload = campaign_summary(campaign)
+	payload['offset'] = offset
+	payload['results'] = results
+	return jsonify(payload)
+
+
+@app.route('/campaigns/<campaign_id>/events', methods=['GET'])
+def campaign_events(campaign_id):
+	campaign = get_campaign(campaign_id)
+	if not campaign:
+		return jsonify({'error': 'Campaign not found', 'error_code': 'error_campaign_not_found'}), 404
+	# EventSource reenvía Last-Event-ID al reconectar; continuamos desde ahí
+	last_event_id = request.headers.get('Last-Event-ID', request.args.get('last_event_id'))
+	try:
+		cursor = int(last_event_id) + 1
+	except (TypeError, ValueError):
+		cursor = 0
+	if not acquire_event_stream():
+		response = jsonify({'error': 'Too many event streams', 'error_code': 'error_too_many_streams'})
+		response.headers['Retry-After'] = '5'
+		return response, 503
+
+	def generate(cursor):
+		yield format_sse('status', campaign_summary(campaign))
+		condition = campaign['condition']
+		while True:
+			with condition:
+				if cursor >= len(campaign['results']) and campaign['status'] not in CAMPAIGN_FINISHED_STATES:
+					condition.wait(timeout=15)
+				pending = campaign['results'][cursor:]
+				finished = campaign['status'] in CAMPAIGN_FINISHED_STATES
+			if not pending and not finished:
+				yield ": keep-alive\n\n"
+				continue
+			for result in pending:
+				yield format_sse('result', result, event_id=cursor)
+				cursor += 1
+			if finished:
+				yield format_sse('done', campaign_summary(campaign))
+				return
+
+	response = Response(stream_with_context(generate(cursor)), mimetype='text/event-stream')
+	response.headers['Cache-Control'] = 'no-cache'
+	response.headers['X-Accel-Buffering'] = 'no'
+	# El servidor WSGI cierra la respuesta al terminar o al desconectarse el cliente
+	response.call_on_close(release_event_stream)
+	return response
 
 @app.route('/health')
 def health():
 	return jsonify({'status': 'OK'})
 
+
+@app.route('/metrics')
+def metrics():
+	lines = [render_metrics().rstrip("\n")]
+	lines.append("# HELP dispatcher_campaigns Campaigns held in memory by status.")
+	lines.append("# TYPE dispatcher_campaigns gauge")
+	with campaigns_lock:
+		statuses = [campaign['status'] for campaign in campaigns.values()]
+	for status in sorted(set(statuses)):
+		lines.append(f'dispatcher_campaigns{{status="{status}"}} {statuses.count(status)}')
+	lines.append("# HELP dispatcher_session_up Whether the session has a Chrome driver running.")
+	lines.append("# TYPE dispatcher_session_up gauge")
+	for session in sessions.values():
+		lines.append(f'dispatcher_session_up{{session="{session["id"]}"}} {1 if session["driver"] else 0}')
+	lines.append("# HELP dispatcher_browser_js_heap_bytes JS heap in use by the WhatsApp tab at the last sample.")
+	lines.append("# TYPE dispatcher_browser_js_heap_bytes gauge")
+	for session in sessions.values():
+		if session['memory']:
+			lines.append(f'dispatcher_browser_js_heap_bytes{{session="{session["id"]}"}} {session["memory"]["js_heap_used"]}')
+	return Response("\n".join(lines) + "\n", mimetype='text/plain; version=0.0.4')
+
 if __name__ == '__main__':
 	def open_ui():
 		if os.getenv("DISPATCHER_AUTO_OPEN", "1") == "1":
 			time.sleep(1.5)
 			webbrowser.open("http://127.0.0.1:5000")
-		if os.getenv("DISPATCHER_AUTO_OPEN_SELENIUM", "0") == "1":
-			try:
-				driver = get_driver()
-				with driver_lock:
-					driver.get("https://web.whatsapp.com")
-			except Exception:
-				pass
 
 	threading.Thread(target=open_ui, daemon=True).start()
+	if PREWARM or os.getenv("DISPATCHER_AUTO_OPEN_SELENIUM", "0") == "1":
+		threading.Thread(target=prewarm_sessions, name="prewarm", daemon=True).start()
+	if RESUME_ON_START:
+		resume_interrupted_campaigns()
 	try:
 		from waitress import serve
-		serve(app, host='127.0.0.1', port=5000)
+		serve(app, host='127.0.0.1', port=5000, threads=SERVER_THREADS)
 	except Exception:
 		app.run(host='127.0.0.1', debug=False, use_reloader=False)
\ No newline at end of file
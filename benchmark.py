@@ -0,0 +1,196 @@
+import argparse
+import json
+import logging
+import math
+import os
+import tempfile
+import time
+
+# Benchmark de rendimiento contra la réplica local de WhatsApp Web (mock_whatsapp.py).
+# Necesita Chrome como en producción, pero no un número real:
+#   python benchmark.py --messages 30 --scenarios send,text,attachment --json resultados.json
+
+SCENARIOS = ('send', 'text', 'attachment')
+
+
+def percentile(values, fraction):
+	if not values:
+		return None
+	ordered = sorted(values)
+	index = min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))
+	return ordered[index]
+
+
+def summarize(name, latencies, elapsed, sent, delivered, errors):
+	return {
+		'scenario': name,
+		'messages': len(latencies) + errors,
+		'sent': sent,
+		'delivered': delivered,
+		'errors': errors,
+		'elapsed_seconds': round(elapsed, 3),
+		'messages_per_minute': round(sent / elapsed * 60, 2) if elapsed > 0 else None,
+		'p50_seconds': round(percentile(latencies, 0.50), 3) if latencies else None,
+		'p95_seconds': round(percentile(latencies, 0.95), 3) if latencies else None
+	}
+
+
+def make_phones(count, offset):
+	return [f"+57300{offset + i:07d}" for i in range(count)]
+
+
+def delivered_count(mock_url):
+	import requests
+	# El mock registra cada entrega con send_delay de retraso; se da un margen antes de contar
+	time.sleep(1)
+	return len(requests.get(f"{mock_url}/__mock__/messages", timeout=10).json()['messages'])
+
+
+def reset_messages(mock_url):
+	import requests
+	requests.delete(f"{mock_url}/__mock__/messages", timeout=10)
+
+
+def run_send(client, mock_url, count, args):
+	reset_messages(mock_url)
+	latencies = []
+	errors = 0
+	started = time.monotonic()
+	for phone in make_phones(count, 0):
+		request_started = time.monotonic()
+		payload = client.post('/send', json={
+			'phone': phone,
+			'message': args.message,
+			'chat_open_mode': args.chat_open_mode,
+			'recheck_invalid': True
+		}).get_json()
+		if payload.get('status') == 'Message sent':
+			latencies.append(time.monotonic() - request_started)
+		else:
+			errors += 1
+	elapsed = time.monotonic() - started
+	return summarize('send', latencies, elapsed, len(latencies), delivered_count(mock_url), errors)
+
+
+def run_campaign(client, mock_url, name, count, offset, args, file_link=None):
+	reset_messages(mock_url)
+	contacts = [{'phone': phone, 'row_index': i} for i, phone in enumerate(make_phones(count, offset))]
+	if file_link:
+		for i, contact in enumerate(contacts):
+			# Un archivo distinto por contacto para medir también la descarga y el prefetch
+			contact['fileLink'] = f"{file_link}/contact-{i}.pdf?kb={args.attachment_kb}"
+	payload = {
+		'message': args.message,
+		'contacts': contacts,
+		'min_interval': args.min_interval,
+		'max_interval': args.max_interval,
+		'burst': count if args.unpaced else 1,
+		'chat_open_mode': args.chat_open_mode,
+		'recheck_invalid': True
+	}
+	response = client.post('/send_all', json=payload)
+	if response.status_code != 202:
+		raise SystemExit(f"{name}: /send_all failed: {response.get_json()}")
+	campaign_id = response.get_json()['campaign_id']
+	client.get(f"/campaigns/{campaign_id}/events").get_data()
+	summary = client.get(f"/campaigns/{campaign_id}/results").get_json()
+	if summary['status'] == 'failed':
+		raise SystemExit(f"{name}: campaign failed: {summary.get('error_code') or summary.get('error')}")
+	latencies = [r['timings']['row_total'] for r in summary['results'] if r['status'] == 'sent' and 'timings' in r]
+	elapsed = (summary['finished_at'] or time.time()) - (summary['started_at'] or time.time())
+	result = summarize(name, latencies, elapsed, summary['counts']['sent'], delivered_count(mock_url), summary['counts']['error'])
+	result['stage_timing'] = summary.get('stage_timing', {})
+	result['recycles'] = summary.get('recycles', [])
+	return result
+
+
+def browser_footprint(dispatcher):
+	# Memoria del tab de WhatsApp y tiempo medio de carga completa de la página
+	heap = [dispatcher.sample_session_memory(session) for session in dispatcher.sessions.values()]
+	heap = [sample['js_heap_used'] for sample in heap if sample]
+	page_load = dispatcher.stage_metrics.get('page_load')
+	return {
+		'js_heap_mb': round(max(heap) / 1024 / 1024, 1) if heap else None,
+		'page_load_seconds': round(page_load['sum'] / page_load['count'], 3) if page_load and page_load['count'] else None
+	}
+
+
+def print_table(results):
+	header = (
+		f"{'scenario':<12}{'msgs':>6}{'sent':>6}{'deliv':>7}{'err':>5}{'msg/min':>10}{'p50 s':>8}{'p95 s':>8}"
+		f"{'heap MB':>9}{'load s':>8}"
+	)
+	print(header)
+	print("-" * len(header))
+	for r in results:
+		print(
+			f"{r['scenario']:<12}{r['messages']:>6}{r['sent']:>6}{r['delivered']:>7}{r['errors']:>5}"
+			f"{r['messages_per_minute'] or 0:>10.1f}{r['p50_seconds'] or 0:>8.3f}{r['p95_seconds'] or 0:>8.3f}"
+			f"{r['js_heap_mb'] or 0:>9.1f}{r['page_load_seconds'] or 0:>8.3f}"
+		)
+
+
+def main():
+	parser = argparse.ArgumentParser(description="DISPATCHER throughput benchmark against the local WhatsApp Web mock")
+	parser.add_argument('--messages', type=int, default=20, help="messages per scenario")
+	parser.add_argument('--scenarios', default=",".join(SCENARIOS), help="comma separated: send,text,attachment")
+	parser.add_argument('--message', default="Hola, este es un mensaje de prueba 👋")
+	parser.add_argument('--chat-open-mode', default='fast', choices=('fast', 'url'))
+	parser.add_argument('--min-interval', type=float, default=0.5)
+	parser.add_argument('--max-interval', type=float, default=0.5)
+	parser.add_argument('--paced', dest='unpaced', action='store_false', help="apply min/max interval between messages")
+	parser.add_argument('--attachment-kb', type=int, default=64)
+	parser.add_argument('--lean', action='store_true', help="run Chrome in lean mode (WHATSAPP_LEAN_MODE=1)")
+	parser.add_argument('--mock-config', default=None, help="JSON with mock latencies/failures, e.g. '{\"chat_delay\": 0.5}'")
+	parser.add_argument('--json', dest='json_path', default=None, help="write results to this file")
+	args = parser.parse_args()
+
+	scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+	unknown = [s for s in scenarios if s not in SCENARIOS]
+	if unknown:
+		parser.error(f"unknown scenarios: {', '.join(unknown)}")
+
+	logging.getLogger('werkzeug').setLevel(logging.WARNING)
+	import mock_whatsapp
+	if args.mock_config:
+		mock_whatsapp.apply_config(json.loads(args.mock_config))
+	server, mock_url = mock_whatsapp.start_mock_server()
+
+	# Estado aislado: perfil de Chrome y carpeta de datos temporales
+	workdir = tempfile.mkdtemp(prefix="dispatcher-bench-")
+	os.environ['WHATSAPP_WEB_URL'] = mock_url
+	os.environ['WHATSAPP_PROFILE_DIR'] = os.path.join(workdir, "profile")
+	os.environ['DISPATCHER_DATA_DIR'] = os.path.join(workdir, "data")
+	os.environ.setdefault('WHATSAPP_HEADLESS', "1")
+	if args.lean:
+		os.environ['WHATSAPP_LEAN_MODE'] = "1"
+	import app as dispatcher
+	client = dispatcher.app.test_client()
+
+	results = []
+	try:
+		for index, scenario in enumerate(scenarios):
+			if scenario == 'send':
+				result = run_send(client, mock_url, args.messages, args)
+			elif scenario == 'text':
+				result = run_campaign(client, mock_url, 'text', args.messages, (index + 1) * 100000, args)
+			else:
+				result = run_campaign(
+					client, mock_url, 'attachment', args.messages, (index + 1) * 100000, args,
+					file_link=f"{mock_url}/__mock__/files"
+				)
+			result.update(browser_footprint(dispatcher))
+			results.append(result)
+	finally:
+		for session in dispatcher.sessions.values():
+			dispatcher.close_driver(session)
+		server.shutdown()
+
+	print_table(results)
+	if args.json_path:
+		with open(args.json_path, "w", encoding="utf-8") as f:
+			json.dump({'mock_config': mock_whatsapp.config, 'lean_mode': args.lean, 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,312 @@
+from flask import Flask, jsonify, request, render_template_string, Response
+import argparse
+import os
+import threading
+
+# Réplica local de las partes de WhatsApp Web que usa app.py (panel, composer, adjuntos y vista previa).
+# Se arranca con `python mock_whatsapp.py` y se apunta DISPATCHER con WHATSAPP_WEB_URL=http://127.0.0.1:5055
+
+mock = Flask(__name__)
+
+DEFAULT_CONFIG = {
+	'load_delay': 0.5,  # segundos hasta que aparece #pane-side
+	'chat_delay': 0.2,  # segundos para abrir un chat
+	'upload_delay': 0.3,  # segundos hasta que aparece la vista previa del adjunto
+	'send_delay': 0.1,  # segundos hasta que el mensaje se da por entregado
+	'invalid_rate': 0.0,  # probabilidad de mostrar el aviso de número inválido
+	'invalid_phones': [],
+	'open_failure_rate': 0.0,  # probabilidad de que el chat no llegue a abrirse
+	'drop_rate': 0.0,  # probabilidad de que un envío se pierda sin error visible
+	'logged_out': False  # muestra el QR en lugar del panel de chats
+}
+
+config_lock = threading.Lock()
+config = dict(DEFAULT_CONFIG)
+messages_lock = threading.Lock()
+messages = []
+
+
+def env_config():
+	updates = {}
+	for key, default in DEFAULT_CONFIG.items():
+		raw = os.getenv(f"MOCK_WHATSAPP_{key.upper()}")
+		if raw is None:
+			continue
+		if isinstance(default, bool):
+			updates[key] = raw == "1"
+		elif isinstance(default, list):
+			updates[key] = [item.strip().lstrip('+') for item in raw.split("|") if item.strip()]
+		else:
+			updates[key] = float(raw)
+	return updates
+
+
+def apply_config(updates):
+	with config_lock:
+		for key, value in updates.items():
+			if key not in DEFAULT_CONFIG:
+				raise Exception(f"error_unknown_setting:{key}")
+			default = DEFAULT_CONFIG[key]
+			if isinstance(default, bool):
+				value = bool(value)
+			elif isinstance(default, list):
+				value = [str(item).lstrip('+') for item in value or []]
+			else:
+				value = float(value)
+			config[key] = value
+		return dict(config)
+
+
+PAGE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>WhatsApp</title>
+<style>
+	body { margin: 0; font-family: sans-serif; }
+	#app { display: flex; height: 100vh; }
+	#pane-side { width: 280px; border-right: 1px solid #ddd; }
+	#main { flex: 1; display: flex; flex-direction: column; position: relative; }
+	#conversation { flex: 1; overflow: auto; padding: 8px; }
+	footer { display: flex; gap: 6px; padding: 8px; border-top: 1px solid #ddd; }
+	footer [role=textbox], [data-testid=media-preview] [role=textbox] { flex: 1; min-height: 20px; border: 1px solid #ccc; padding: 4px; }
+	[data-testid=attach-menu] { position: absolute; bottom: 50px; left: 8px; background: #fff; border: 1px solid #ccc; padding: 8px; }
+	[data-testid=media-preview] { position: absolute; inset: 0; background: #f0f2f5; display: flex; flex-direction: column; justify-content: flex-end; padding: 8px; gap: 6px; }
+	[data-animate-modal-popup] { position: fixed; top: 40%; left: 35%; background: #fff; border: 1px solid #999; padding: 16px; }
+</style>
+</head>
+<body>
+<div id="app"><div id="startup">Loading…</div></div>
+<script>
+var CONFIG = {{ config|tojson }};
+var INITIAL = {{ initial|tojson }};
+var app = document.getElementById('app');
+var state = {phone: null, files: []};
+
+function later(seconds, fn) { setTimeout(fn, Math.max(0, seconds) * 1000); }
+function chance(rate) { return Math.random() < rate; }
+function isInvalid(phone) { return CONFIG.invalid_phones.indexOf(phone) !== -1 || chance(CONFIG.invalid_rate); }
+
+function record(payload) {
+	var body = JSON.stringify(Object.assign({phone: state.phone, at: Date.now() / 1000}, payload));
+	later(CONFIG.send_delay, function () {
+		if (chance(CONFIG.drop_rate)) return;
+		fetch('/__mock__/messages', {method: 'POST', headers: {'Content-Type': 'application/json'}, body: body});
+	});
+}
+
+function composerText(el) { return (el.innerText || '').replace(/\\n+$/, ''); }
+
+function wireComposer(el, onSend) {
+	// WhatsApp inserta el texto pegado por su cuenta; un evento de pegado sintético no lo haría
+	el.addEventListener('paste', function (event) {
+		event.preventDefault();
+		document.execCommand('insertText', false, event.clipboardData.getData('text/plain'));
+	});
+	el.addEventListener('keydown', function (event) {
+		if (event.key === 'Enter' && !event.shiftKey) {
+			event.preventDefault();
+			onSend();
+		}
+	});
+}
+
+function renderShell() {
+	app.innerHTML = '';
+	if (CONFIG.logged_out) {
+		app.innerHTML = '<div data-testid="qrcode"><canvas aria-label="Scan me!"></canvas></div>';
+		return;
+	}
+	var pane = document.createElement('div');
+	pane.id = 'pane-side';
+	pane.innerHTML = '<div role="textbox" contenteditable="true" aria-label="Search input textbox"></div>';
+	var main = document.createElement('div');
+	main.id = 'main';
+	app.appendChild(pane);
+	app.appendChild(main);
+}
+
+function renderChat(phone, text) {
+	var main = document.getElementById('main');
+	state.phone = phone;
+	state.files = [];
+	main.innerHTML = '<header>' + phone + '</header><div id="conversation"></div>';
+	var footer = document.createElement('footer');
+	var clip = document.createElement('span');
+	clip.setAttribute('data-icon', 'clip');
+	clip.setAttribute('role', 'button');
+	clip.textContent = '📎';
+	var box = document.createElement('div');
+	box.setAttribute('role', 'textbox');
+	box.setAttribute('contenteditable', 'true');
+	box.setAttribute('aria-label', 'Type a message');
+	box.setAttribute('data-tab', '10');
+	if (text) box.textContent = text;
+	var send = document.createElement('button');
+	send.setAttribute('data-testid', 'send');
+	send.setAttribute('aria-label', 'Send');
+	send.textContent = '➤';
+	function sendText() {
+		var value = composerText(box);
+		if (!value.trim()) return;
+		box.innerHTML = '';
+		record({text: value, files: []});
+		var bubble = document.createElement('div');
+		bubble.textContent = value;
+		document.getElementById('conversation').appendChild(bubble);
+	}
+	wireComposer(box, sendText);
+	send.addEventListener('click', sendText);
+	clip.addEventListener('click', function () { openAttachMenu(main, footer); });
+	footer.appendChild(clip);
+	footer.appendChild(box);
+	footer.appendChild(send);
+	main.appendChild(footer);
+}
+
+function openAttachMenu(main, footer) {
+	if (main.querySelector('[data-testid=attach-menu]')) return;
+	var menu = document.createElement('div');
+	menu.setAttribute('data-testid', 'attach-menu');
+	menu.innerHTML = '<span data-icon="document" role="button">Document</span>'
+		+ '<input type="file" data-testid="attach-doc" accept="*" multiple style="display:none">';
+	var input = menu.querySelector('input');
+	input.addEventListener('change', function () {
+		var names = Array.prototype.map.call(input.files, function (file) { return file.name; });
+		menu.remove();
+		later(CONFIG.upload_delay, function () { openPreview(main, footer, names); });
+	});
+	main.appendChild(menu);
+}
+
+function openPreview(main, footer, names) {
+	footer.style.display = 'none';
+	var preview = document.createElement('div');
+	preview.setAttribute('data-testid', 'media-preview');
+	preview.innerHTML = '<div>' + names.join(', ') + '</div>';
+	var caption = document.createElement('div');
+	caption.setAttribute('role', 'textbox');
+	caption.setAttribute('contenteditable', 'true');
+	caption.setAttribute('aria-label', 'Add a caption');
+	caption.setAttribute('data-testid', 'media-caption-input-container');
+	var send = document.createElement('button');
+	send.setAttribute('data-testid', 'send');
+	send.setAttribute('aria-label', 'Send');
+	send.textContent = '➤';
+	function sendMedia() {
+		record({text: composerText(caption), files: names});
+		preview.remove();
+		footer.style.display = '';
+	}
+	wireComposer(caption, sendMedia);
+	send.addEventListener('click', sendMedia);
+	preview.appendChild(caption);
+	preview.appendChild(send);
+	main.appendChild(preview);
+}
+
+function showInvalid() {
+	var popup = document.createElement('div');
+	popup.setAttribute('data-animate-modal-popup', 'true');
+	popup.setAttribute('role', 'dialog');
+	popup.innerHTML = '<div>Phone number shared via url is invalid.</div><button>OK</button>';
+	popup.querySelector('button').addEventListener('click', function () { popup.remove(); });
+	document.body.appendChild(popup);
+}
+
+function openChat(phone, text) {
+	phone = (phone || '').replace(/\\D/g, '');
+	later(CONFIG.chat_delay, function () {
+		if (isInvalid(phone)) { showInvalid(); return; }
+		if (chance(CONFIG.open_failure_rate)) return;
+		renderChat(phone, text);
+	});
+}
+
+// Los enlaces api.whatsapp.com/send se abren dentro de la SPA, como en WhatsApp Web
+document.addEventListener('click', function (event) {
+	var link = event.target.closest && event.target.closest('a[href*="/send?phone="]');
+	if (!link) return;
+	event.preventDefault();
+	openChat(new URL(link.href).searchParams.get('phone'), '');
+}, true);
+
+later(CONFIG.load_delay, function () {
+	renderShell();
+	if (!CONFIG.logged_out && INITIAL.phone !== null) openChat(INITIAL.phone, INITIAL.text);
+});
+</script>
+</body>
+</html>
+"""
+
+
+def render_page(phone=None, text=""):
+	with config_lock:
+		current = dict(config)
+	return render_template_string(PAGE, config=current, initial={'phone': phone, 'text': text})
+
+
+@mock.route('/')
+def index():
+	return render_page()
+
+
+@mock.route('/send')
+def send():
+	return render_page(request.args.get('phone', ''), request.args.get('text', ''))
+
+
+@mock.route('/__mock__/config', methods=['GET', 'POST'])
+def mock_config():
+	if request.method == 'GET':
+		with config_lock:
+			return jsonify(config)
+	try:
+		return jsonify(apply_config(request.get_json(silent=True) or {}))
+	except Exception as e:
+		return jsonify({'error': str(e)}), 400
+
+
+@mock.route('/__mock__/messages', methods=['GET', 'POST', 'DELETE'])
+def mock_messages():
+	with messages_lock:
+		if request.method == 'POST':
+			messages.append(request.get_json(silent=True) or {})
+			return jsonify({'status': 'recorded'})
+		if request.method == 'DELETE':
+			messages.clear()
+			return jsonify({'status': 'cleared'})
+		return jsonify({'messages': list(messages)})
+
+
+@mock.route('/__mock__/files/<name>')
+def mock_file(name):
+	# Adjunto de prueba para enlaces por contacto (tamaño con ?kb=)
+	size = max(1, request.args.get('kb', 64, type=int)) * 1024
+	etag = f'"{name}-{size}"'
+	# Revalidación como un servidor real: mismo ETag -> 304 sin cuerpo
+	if etag in [tag.strip() for tag in request.headers.get('If-None-Match', '').split(',')]:
+		response = Response(status=304)
+	else:
+		response = Response(b"%PDF-1.4\n" + b"0" * size, mimetype='application/pdf')
+		response.headers['Content-Disposition'] = f'attachment; filename="{name}"'
+	response.headers['ETag'] = etag
+	return response
+
+
+def start_mock_server(host='127.0.0.1', port=0):
+	from werkzeug.serving import make_server
+	server = make_server(host, port, mock, threaded=True)
+	threading.Thread(target=server.serve_forever, name="mock-whatsapp", daemon=True).start()
+	return server, f"http://{host}:{server.server_port}"
+
+
+apply_config(env_config())
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description="Local WhatsApp Web stand-in for DISPATCHER")
+	parser.add_argument('--host', default='127.0.0.1')
+	parser.add_argument('--port', type=int, default=5055)
+	args = parser.parse_args()
+	mock.run(host=args.host, port=args.port, threaded=True, debug=False, use_reloader=False)